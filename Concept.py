@@ -29,48 +29,63 @@ FIELD_NAMES_UA = ('index', 'ua', 'short_form', 'long_form', 'num_tokens_short_fo
                   'num_chars_short_form', 'num_tokens_long_form',
                   'num_chars_long_form', 'pos_info')
 
-class ConceptMMI(namedtuple('Concept', FIELD_NAMES_MMI)):
-    def __repr__(self):
-        items = [(field, getattr(self, field, None)) for field in FIELD_NAMES_MMI]
-        fields = ['%s=%r' % (k, v) for k, v in items if v is not None]
-        return '%s(%s)' % (self.__class__.__name__, ', '.join(fields))
-
-    def as_mmi(self):
-        return '|'.join([get(field) for field in FIELD_NAMES_MMI])
+# record types are tuples without per-instance dict (__slots__ = ()), built directly from the fields of an MMI line
+class ConceptRecord(object):
+    __slots__ = ()
+    FIELD_NAMES = ()
 
-    @classmethod
-    def from_mmi(this_class, line):
-         fields = line.split('|')
-         fields.append(fields[6].split('-')[4])  #add POS info (slot 4) from trigger info (slot 6)
-         return this_class(**dict(zip(FIELD_NAMES_MMI, fields)))
-
-class ConceptAA(namedtuple('Concept', FIELD_NAMES_AA)):
     def __repr__(self):
-        items = [(field, getattr(self, field, None)) for field in FIELD_NAMES_AA]
+        items = [(field, getattr(self, field, None)) for field in self.FIELD_NAMES]
         fields = ['%s=%r' % (k, v) for k, v in items if v is not None]
         return '%s(%s)' % (self.__class__.__name__, ', '.join(fields))
 
     def as_mmi(self):
-        return '|'.join([get(field) for field in FIELD_NAMES_AA])
+        return '|'.join(field or '' for field in self)
 
     @classmethod
     def from_mmi(this_class, line):
-         fields = line.split('|')
-         return this_class(**dict(zip(FIELD_NAMES_AA, fields)))
-
-class ConceptUA(namedtuple('Concept', FIELD_NAMES_UA)):
-    def __repr__(self):
-        items = [(field, getattr(self, field, None)) for field in FIELD_NAMES_UA]
-        fields = ['%s=%r' % (k, v) for k, v in items if v is not None]
-        return '%s(%s)' % (self.__class__.__name__, ', '.join(fields))
-
-    def as_mmi(self):
-        return '|'.join([get(field) for field in FIELD_NAMES_UA])
+         return this_class.from_fields(line.split('|'))
 
+    # record from split MMI line, missing fields are None
     @classmethod
-    def from_mmi(this_class, line):
-         fields = line.split('|')
-         return this_class(**dict(zip(FIELD_NAMES_UA, fields)))
+    def from_fields(this_class, fields):
+        if len(fields) != len(this_class._fields):
+            fields = (fields + [None] * len(this_class._fields))[:len(this_class._fields)]
+        return tuple.__new__(this_class, fields)
+
+class ConceptMMI(ConceptRecord, namedtuple('Concept', FIELD_NAMES_MMI[:-1])):
+    __slots__ = ()
+    FIELD_NAMES = FIELD_NAMES_MMI
+
+    # POS info (slot 4) from trigger info (slot 6), parsed on access
+    @property
+    def pos(self):
+        return self.trigger.split('-')[4]
+
+class ConceptAA(ConceptRecord, namedtuple('Concept', FIELD_NAMES_AA)):
+    __slots__ = ()
+    FIELD_NAMES = FIELD_NAMES_AA
+
+class ConceptUA(ConceptRecord, namedtuple('Concept', FIELD_NAMES_UA)):
+    __slots__ = ()
+    FIELD_NAMES = FIELD_NAMES_UA
+
+RECORD_TYPES = {'MMI': ConceptMMI, 'AA': ConceptAA, 'UA': ConceptUA}
+
+# streaming MMI parser: yields ConceptMMI, ConceptAA and ConceptUA records from MMI text, an iterable of lines
+# (str or bytes, e.g. a text or binary file) without collecting them, one split per line
+def iter_mmi(stream):
+    if isinstance(stream, (str, bytes)):
+        stream = stream.splitlines()
+    for line in stream:
+        if type(line) is bytes:
+            line = line.decode('utf-8', 'replace')
+        #strip angle brackets from outer edges of MMI fields, then split into fields
+        fields = line.rstrip('\r\n').replace('|[', '|').replace(']|', '|').split('|')
+        if len(fields) > 1:
+            record_type = RECORD_TYPES.get(fields[1])
+            if record_type is not None:
+                yield record_type.from_fields(fields)
 
 class Corpus(list):
     #strip angle brackets from outer edges of MMI fields
@@ -81,27 +96,12 @@ class Corpus(list):
         return text
         
     def loadLine(self, line):
-        line = self.stripBrackets(line)
-        fields = self.stripBrackets(line).split('|')
-        if len(fields) > 1:
-            if fields[1] == 'MMI':
-                self.append(ConceptMMI.from_mmi(line))
-            elif fields[1] == 'AA':
-                self.append(ConceptAA.from_mmi(line))
-            elif fields[1] == 'UA':
-                self.append(ConceptUA.from_mmi(line))
+        self.extend(iter_mmi((line,)))
         
     @classmethod
     def fromFile(this_class, stream):
-        stream = iter(stream)
-        corpus = this_class()
-        for line in stream:
-            corpus.loadLine(line)
-        return corpus
+        return this_class(iter_mmi(stream))
 
     @classmethod
     def fromText(this_class, text):
-        corpus = this_class()
-        for line in text.splitlines():
-            corpus.loadLine(line)
-        return corpus
+        return this_class(iter_mmi(text))
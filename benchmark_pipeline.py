@@ -0,0 +1,216 @@
+# Pipeline benchmark harness: synthetic curricula (objectives csv file and MetaMap MMI output) of 10k, 100k and 1M objectives,
+# generated from the action verb list (BloomsLists_NewtonEtAL_2020.csv) and recognised concepts (concepts.csv), are processed by the
+# pipeline functions of extract_actionverbs.py (ingest_objectives, update_actverbs), bloom_summary.py and map_concepts_metamap.py
+# (map_batch, with the MetaMap batch output replayed from the synthetic MMI file) on a new database and sentence/MetaMap cache.
+# The pipeline functions record their stages with utils.StageProfiler: wall time, CPU time, throughput and peak memory (RSS) per stage.
+# Results are appended to a JSON lines file (one run per line, with run info and git commit), so regressions and scaling curves can
+# be tracked from run to run. Stages:
+#   csv cleaning: read, clean, deduplicate and hash objective rows (clean_rows, unique_rows, hashed_rows), db objectives: objectives writes
+#   split sentences: sentence splitting via utils.SentenceCache (extract_actionverbs.objective_actverbs)
+#   action verbs: all action verbs per sentence (utils.ActionVerbMatcher), db AVmap: AVmap writes
+#   bloom summaries: bloom_summary.update_summaries
+#   split sentences (MetaMap), MetaMap batch (batch output incl. response cache), MMI parsing, concept mapping, db objMap: map_concepts_metamap.map_batch
+# utils.get_actverb is no longer used by the pipeline, benchmarks.py actverbs compares it with the action verb matcher.
+# Synthetic input files are kept in the data directory and reused by later runs.
+#
+# usage: python benchmark_pipeline.py [--sizes 10000 100000 1000000] [--output pipeline_benchmark.jsonl] [--data benchmark_data]
+#
+# Stephan Bandelow, January 2024
+
+import os
+import csv
+import json
+import time
+import random
+import sqlite3
+import argparse
+import platform
+import subprocess
+from contextlib import redirect_stdout
+import utils
+import extract_actionverbs
+import bloom_summary
+import map_concepts_metamap
+from metamap_client import MMICache, MetaMapBatch
+from metamap_standin import mmi_line
+
+############## synthetic curricula ##################
+
+# synthetic curriculum of count objectives: objectives csv file and MetaMap batch output (MMI file) of all sentences
+# Objectives have 1-3 sentences in 5 courses, 60 modules and 12 disciplines, about 1% duplicate codes. Sentences start with an
+# action verb, some with coordinated action verbs or an action verb modifier ('Using the ..., describe ...'), and contain stray
+# characters for pre-processing (quotes, tabs, double spaces, zero width spaces).
+# MMI lines are tagged objective ID.sentence number, with the IDs the unique objectives get in a new database: 2-6 concepts of
+# the sentence, POS mostly nouns, some abbreviation (AA) lines
+def synthetic_curriculum (objfile, mmifile, count, seed = 0):
+    rnd = random.Random(seed)
+    with open('BloomsLists_NewtonEtAL_2020.csv', encoding = 'utf-8-sig') as f:
+        verbs = [row['verb'].replace('_', ' ') for row in csv.DictReader(f)]
+    with open('concepts.csv', encoding = 'utf-8') as f:
+        concepts = list(csv.DictReader(f))
+    fillers = ['the', 'an', 'a', 'of', 'and', 'in', 'to', 'by', 'from', 'which', '(e.g.', 'their', 'main', 'with', 'between']
+    stray = ['"', '\t', '  ', '\u200b', "'"]
+    # sentence text and its concepts
+    def sentence ():
+        words = [rnd.choice(verbs)]
+        if rnd.random() < 0.15:
+            words = [rnd.choice(verbs) + ','] + words if rnd.random() < 0.5 else words + ['and', rnd.choice(verbs)]
+        found = []
+        if rnd.random() < 0.1:
+            found.append(rnd.choice(concepts))
+            words = ['Using the', found[-1]['token'] + ','] + words
+        for i in range(rnd.randint(6, 20)):
+            if rnd.random() < 0.4:
+                words.append(rnd.choice(fillers))
+            else:
+                found.append(rnd.choice(concepts))
+                words.append(found[-1]['token'])
+        if rnd.random() < 0.05:
+            words.insert(rnd.randrange(1, len(words)), rnd.choice(stray))
+        text = ' '.join(words)
+        return text[0].upper() + text[1:] + '.', found
+    codes = set()
+    with open(objfile, 'w', encoding = 'utf-8-sig', newline = '') as f, open(mmifile, 'w', encoding = 'utf-8') as mmi:
+        writer = csv.writer(f)
+        writer.writerow(['course', 'module', 'discipline', 'lecture', 'title', 'code', 'objective'])
+        for i in range(count):
+            module = rnd.randrange(60)
+            code = 'LO' + str(rnd.randrange(i) if i > 0 and rnd.random() < 0.01 else i)
+            lecture = 'L' + str(module) + '.' + str(rnd.randrange(20))
+            sentences = [sentence() for j in range(rnd.choice((1, 1, 2, 3)))]
+            writer.writerow(['course' + str(module % 5), 'module' + str(module), 'discipline' + str(module % 12), lecture, 'Lecture ' + lecture,
+                             code, ' '.join(text for text, found in sentences)])
+            if code in codes:
+                continue    # duplicate, not in database
+            codes.add(code)
+            for sentnum, (text, found) in enumerate(sentences):
+                itemid = str(len(codes)) + '.' + str(sentnum)
+                if rnd.random() < 0.04:
+                    mmi.write(itemid + '|AA|ECG|electrocardiogram|1|3|1|17|10:3\n')
+                for concept in rnd.sample(found, min(len(found), rnd.randint(2, 6))):
+                    line = mmi_line(concept, concept['token'], text.find(concept['token']), rnd.uniform(1, 20), itemid) + 'A07.541\n'
+                    mmi.write(line if rnd.random() < 0.8 else line.replace('-noun-', '-verb-'))
+
+# synthetic input files (objectives csv, MMI) for count objectives in data directory, generated once
+def synthetic_files (datadir, count, seed = 0):
+    os.makedirs(datadir, exist_ok = True)
+    objfile, mmifile = [os.path.join(datadir, 'curriculum_' + str(count) + ext) for ext in ('.csv', '.mmi')]
+    if not (os.path.exists(objfile) and os.path.exists(mmifile)):
+        start = time.perf_counter()
+        synthetic_curriculum(objfile + '.tmp', mmifile + '.tmp', count, seed)
+        os.replace(mmifile + '.tmp', mmifile)
+        os.replace(objfile + '.tmp', objfile)
+        print ('Generated ' + objfile + ', ' + mmifile + ' (%.1f s).' % (time.perf_counter() - start))
+    return objfile, mmifile
+
+# MetaMap batch runner (metamap_client.MetaMapBatch) replaying batch output from an MMI file, abbreviation long form batches
+# (IDs AA<n>) are answered with one concept per long form
+class ReplayRunner:
+    def __init__(self, mmifile):
+        self.mmifile = mmifile
+        with open('concepts.csv', encoding = 'utf-8') as f:
+            self.concept = next(csv.DictReader(f))
+
+    def __call__(self, infile, args):
+        with open(infile, encoding = 'utf-8') as f:
+            if f.read(2) == 'AA':
+                f.seek(0)
+                for line in f:
+                    itemid, text = line.rstrip('\n').split('|', 1)
+                    yield mmi_line(self.concept, text, 0, 10.0, itemid) + '\n'
+                return
+        with open(self.mmifile, encoding = 'utf-8') as f:
+            yield from f
+
+
+############## pipeline runs ##################
+
+# git commit of the working tree (None outside a git repository)
+def git_commit ():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output = True, text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# last run with count objectives in results file, None if there is none
+def previous_run (filename, count):
+    previous = None
+    if os.path.exists(filename):
+        with open(filename, encoding = 'utf-8') as f:
+            for line in f:
+                run = json.loads(line)
+                if run.get('objectives') == count:
+                    previous = run
+    return previous
+
+# remove database file with its WAL files
+def remove_db (dbfile):
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(dbfile + suffix):
+            os.remove(dbfile + suffix)
+
+# both pipelines for count objectives on a new database and cache (action verb dictionaries from curriculum.db), return profiler
+# the progress lines of the pipeline functions are suppressed
+def run_pipeline (count, datadir, table_AV, dict_RPL):
+    objfile, mmifile = synthetic_files(datadir, count)
+    with open(mmifile, 'rb') as f:
+        mmilines = sum(1 for line in f)
+    dbfile, cachefile = os.path.join(datadir, 'benchmark.db'), os.path.join(datadir, 'benchmark_cache.db')
+    remove_db(dbfile)
+    remove_db(cachefile)
+    dbcon = sqlite3.connect(dbfile, detect_types = sqlite3.PARSE_DECLTYPES)
+    utils.createTables(dbcon)
+    dbcon.executemany('INSERT INTO actionVerbs (id, verb, bloom) VALUES (?, ?, ?)', table_AV)
+    dbcon.executemany('INSERT INTO replaceMap (token, replace) VALUES (?, ?)', dict_RPL.items())
+    dbcon.commit()
+    profiler = utils.StageProfiler(objectives = count, time = time.strftime('%Y-%m-%dT%H:%M:%S'), commit = git_commit(),
+                                   python = platform.python_version(), platform = platform.platform(), mmilines = mmilines)
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        # extract_actionverbs.py
+        extract_actionverbs.ingest_objectives(dbcon, objfile, dupfilename = os.devnull, profiler = profiler)
+        extract_actionverbs.update_actverbs(dbcon, 1, dbfile, cachefile, profiler)
+        with profiler.stage('bloom summaries') as stage:
+            stage['items'] += bloom_summary.update_summaries(dbcon)[1]
+        # map_concepts_metamap.py in batch mode
+        mm = map_concepts_metamap
+        sentcache = utils.SentenceCache(cachefile)
+        mmcache = MMICache(cachefile, version = mm.mm_version, maxbytes = 512 * 2**20, invalidate = True, args = mm.mmargs)
+        registry = utils.ConceptRegistry(dbcon)
+        objectives = utils.db_readSQL(dbcon, 'SELECT * FROM objectives WHERE mmhash IS NOT texthash')
+        mm.map_batch(dbcon, registry, objectives, MetaMapBatch(ReplayRunner(mmifile), mm.mmargs, mmcache), sentcache, profiler)
+        mmcache.close()
+        sentcache.close()
+    profiler.info['unique'] = len(objectives)
+    dbcon.close()
+    remove_db(dbfile)
+    remove_db(cachefile)
+    return profiler
+
+def print_run (run, previous):
+    print ('%d objectives (%d unique), %d MMI lines: %.1f s, peak RSS %.0f MB' % (run['objectives'], run['unique'], run['mmilines'], run['wall_s'], run['peak_rss_mb'] or 0))
+    before = dict((stage['stage'], stage) for stage in previous['stages']) if previous else {}
+    print ('%26s %10s %10s %12s %14s %9s' % ('stage', 'items', 'time (s)', 'items/s', 'peak RSS (MB)', 'vs last'))
+    for stage in run['stages']:
+        last = before.get(stage['stage'])
+        change = '%8.2fx' % (stage['items_per_s'] / last['items_per_s']) if last and last.get('items_per_s') and stage['items_per_s'] else ''
+        print ('%26s %10d %10.3f %12.0f %14.1f %9s' % (stage['stage'], stage['items'], stage['wall_s'], stage['items_per_s'] or 0, stage['peak_rss_mb'] or 0, change))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Benchmark the action verb and concept mapping pipeline stages on synthetic curricula.')
+    parser.add_argument('--sizes', type = int, nargs = '+', default = [10000, 100000, 1000000], help = 'numbers of objectives')
+    parser.add_argument('--output', default = 'pipeline_benchmark.jsonl', help = 'JSON lines results file, one run per line (appended)')
+    parser.add_argument('--data', default = 'benchmark_data', help = 'directory for synthetic input files (reused), the benchmark database and cache')
+    args = parser.parse_args()
+
+    dbcon = sqlite3.connect('curriculum.db')
+    table_AV = utils.db_readSQL(dbcon, 'SELECT id, verb, bloom FROM actionVerbs')
+    dict_RPL = dict(utils.db_readSQL(dbcon, 'SELECT token, replace FROM replaceMap'))
+    dbcon.close()
+    for count in args.sizes:
+        previous = previous_run(args.output, count)
+        profiler = run_pipeline(count, args.data, table_AV, dict_RPL)
+        run = profiler.result()
+        print_run(run, previous)
+        profiler.save(args.output)
+    print ('Results appended to ' + args.output + '.')
@@ -0,0 +1,334 @@
+# Performance benchmarks for the curriculum processing pipelines
+# usage: python benchmarks.py [benchmark name[:argument] ...]   (runs all benchmarks if no name given)
+#   actverbs[:sentences]: action verb extraction, get_actverb vs ActionVerbMatcher (default: 20000 sentences)
+#   mmi[:file]: MMI parser on MetaMap output file (default: generated file)
+#   vectors[:rows]: vector column loading (default: 50000 vectors)
+#   similarity[:rows]: top-k objective similarity search (default: 20000 objectives)
+#   overlap[:objectives]: curriculum overlap reports (default: 100000 objectives)
+#   queries[:objectives]: analysis queries before and after schema indexes and pragmas (default: 100000 objectives)
+#
+# Stephan Bandelow, January 2024
+
+import sys
+import csv
+import time
+import random
+import sqlite3
+import tempfile
+import multiprocessing
+import utils
+
+# time fn(*args) over repeats, return best time in seconds
+def timeit (fn, *args, repeats = 3):
+    best = float('inf')
+    for i in range(repeats):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+# synthetic objective sentences from the action verb list and recognised concepts
+def synthetic_sentences (count, seed = 0):
+    rnd = random.Random(seed)
+    with open('BloomsLists_NewtonEtAL_2020.csv', encoding = 'utf-8-sig') as f:
+        verbs = [row['verb'] for row in csv.DictReader(f)]
+    with open('concepts.csv', encoding = 'utf-8') as f:
+        concepts = [row['token'] for row in csv.DictReader(f)]
+    fillers = ['the', 'an', 'a', 'of', 'and', 'in', 'to', 'by', 'from', 'which', '(e.g.', 'based on', 'their', 'main']
+    sentences = []
+    for i in range(count):
+        words = [rnd.choice(verbs).capitalize()]
+        for j in range(rnd.randint(6, 20)):
+            words.append(rnd.choice(fillers) if rnd.random() < 0.4 else rnd.choice(concepts))
+        sentences.append(' '.join(words) + '.')
+    return sentences
+
+# utils.replace_all dictionary loop vs compiled utils.Replacer, for growing dictionary sizes
+def bench_replace ():
+    dbcon = sqlite3.connect('curriculum.db')
+    dict_RPL = dict(utils.db_readSQL(dbcon, 'SELECT token, replace FROM replaceMap'))
+    dbcon.close()
+    with open('concepts.csv', encoding = 'utf-8') as f:
+        extra = [' ' + row['token'].lower() + ' ' for row in csv.DictReader(f)]
+    sentences = [s.lower() for s in synthetic_sentences(2000)]
+    print('replace_all vs Replacer, %d sentences' % len(sentences))
+    print('%8s %12s %12s %9s' % ('entries', 'loop (s)', 'compiled (s)', 'speedup'))
+    for size in (len(dict_RPL), 100, 250, 500, 1000, 2000, 4000):
+        dictionary = dict(dict_RPL)
+        for token in extra[:max(size - len(dict_RPL), 0)]:
+            dictionary.setdefault(token, ' ')
+        replacer = utils.Replacer(dictionary)
+        assert [utils.replace_all(s, dictionary) for s in sentences] == [replacer(s) for s in sentences], 'output mismatch'
+        tloop = timeit(lambda: [utils.replace_all(s, dictionary) for s in sentences])
+        tcomp = timeit(lambda: [replacer(s) for s in sentences])
+        print('%8d %12.4f %12.4f %8.1fx' % (len(dictionary), tloop, tcomp, tloop / tcomp))
+
+# action verb extraction: utils.get_actverb (primary action verb only) vs compiled utils.ActionVerbMatcher (all action verbs)
+def bench_actverbs (count = 20000):
+    dbcon = sqlite3.connect('curriculum.db')
+    table_AV = utils.db_readSQL(dbcon, 'SELECT id, verb, bloom FROM actionVerbs')
+    dict_RPL = dict(utils.db_readSQL(dbcon, 'SELECT token, replace FROM replaceMap'))
+    dbcon.close()
+    dict_AV = dict((row[1], idx) for idx, row in enumerate(table_AV))
+    sentences = synthetic_sentences(int(count))
+    rnd = random.Random(1)
+    for i in range(0, len(sentences), 4):
+        # coordinated action verbs, as in 'list, describe and analyse ...'
+        sentences[i] = rnd.choice(table_AV)[1].capitalize() + rnd.choice([', ', ' and ', ' or ']) + sentences[i].lower()
+    replacer = utils.Replacer(dict_RPL)
+    matcher = utils.ActionVerbMatcher(table_AV, dict_RPL)
+    old = [utils.get_actverb(sentence, dict_AV, replacer) for sentence in sentences]
+    new = matcher.match_all(sentences)
+    same = sum(1 for verb, verbs in zip(old, new) if verb == (verbs[0].verb if verbs else ''))
+    tget = timeit(lambda: [utils.get_actverb(sentence, dict_AV, replacer) for sentence in sentences])
+    tmatch = timeit(matcher.match_all, sentences)
+    print('action verbs, %d sentences' % len(sentences))
+    print('%14s %10s %9s %9s' % ('', 'time (s)', 'sentences', 'verbs'))
+    print('%14s %10.4f %9d %9d' % ('get_actverb', tget, sum(1 for verb in old if verb), sum(1 for verb in old if verb)))
+    print('%14s %10.4f %9d %9d' % ('matcher', tmatch, sum(1 for verbs in new if verbs), sum(len(verbs) for verbs in new)))
+    print('same primary action verb: %d/%d sentences' % (same, len(sentences)))
+
+# MetaMap client throughput against local stand-in server (simulated latency), for growing concurrency
+def bench_metamap ():
+    from metamap_client import MetaMapClient, HTTPTransport, MetaMapBatch, HTTPBatchRunner, MMICache
+    from Concept import Corpus
+    from metamap_standin import StandinMetaMap
+    latency = 0.02
+    sentences = synthetic_sentences(400)
+    standin = StandinMetaMap(latency = latency)
+    server, url = standin.serve()
+    print('MetaMap client, %d sentences, %.0f ms simulated latency per request' % (len(sentences), latency * 1000))
+    print('%11s %10s %12s' % ('concurrency', 'time (s)', 'requests/s'))
+    expected = None
+    for concurrency in (1, 4, 16, 32):
+        client = MetaMapClient(HTTPTransport(url), '-N', concurrency = concurrency)
+        start = time.perf_counter()
+        responses = client.map_texts(sentences)
+        elapsed = time.perf_counter() - start
+        expected = expected or responses
+        assert responses == expected, 'response order mismatch'
+        print('%11d %10.3f %12.1f' % (concurrency, elapsed, len(sentences) / elapsed))
+    # single batch job, responses streamed into a temporary response cache
+    with tempfile.TemporaryDirectory() as tmpdir:
+        batch = MetaMapBatch(HTTPBatchRunner(url), '-N', MMICache(tmpdir + '/cache.db'))
+        start = time.perf_counter()
+        responses = dict(batch.run((str(n), sentence) for n, sentence in enumerate(sentences)))
+        elapsed = time.perf_counter() - start
+        parsed = lambda mmi: [(c.cui, c.score, c.trigger) for c in Corpus.fromText(mmi)]
+        assert [parsed(responses[str(n)]) for n in range(len(sentences))] == [parsed(mmi) for mmi in expected], 'batch response mismatch'
+        batch.cache.close()
+    print('%11s %10.3f %12.1f' % ('batch', elapsed, len(sentences) / elapsed))
+    server.shutdown()
+
+# synthetic MetaMap MMI output file (sentence-tagged MMI and AA lines), from concepts in concepts.csv
+def synthetic_mmi (filename, lines, seed = 0):
+    from metamap_standin import mmi_line
+    rnd = random.Random(seed)
+    with open('concepts.csv', encoding = 'utf-8') as f:
+        concepts = list(csv.DictReader(f))
+    with open(filename, 'w', encoding = 'utf-8') as f:
+        for n in range(lines):
+            itemid = str(n // 8) + '.' + str(n % 3)
+            if n % 25 == 0:
+                f.write(itemid + '|AA|ECG|electrocardiogram|1|3|1|17|10:3\n')
+            else:
+                concept = rnd.choice(concepts)
+                f.write(mmi_line(concept, concept['token'], rnd.randint(0, 200), rnd.uniform(1, 20), itemid) + 'A07.541\n')
+
+# MMI parser before streaming parser (for comparison): brackets stripped and line split twice, records built via dict
+def legacy_corpus (stream):
+    from collections import namedtuple
+    from Concept import FIELD_NAMES_MMI, FIELD_NAMES_AA, FIELD_NAMES_UA
+    class LegacyMMI(namedtuple('Concept', FIELD_NAMES_MMI)): pass
+    class LegacyAA(namedtuple('Concept', FIELD_NAMES_AA)): pass
+    class LegacyUA(namedtuple('Concept', FIELD_NAMES_UA)): pass
+    corpus = []
+    for line in stream:
+        line = line.replace('|[', '|').replace(']|', '|')
+        fields = line.replace('|[', '|').replace(']|', '|').split('|')
+        if len(fields) > 1:
+            if fields[1] == 'MMI':
+                fields = line.split('|')
+                fields.append(fields[6].split('-')[4])
+                corpus.append(LegacyMMI(**dict(zip(FIELD_NAMES_MMI, fields))))
+            elif fields[1] == 'AA':
+                corpus.append(LegacyAA(**dict(zip(FIELD_NAMES_AA, line.split('|')))))
+            elif fields[1] == 'UA':
+                corpus.append(LegacyUA(**dict(zip(FIELD_NAMES_UA, line.split('|')))))
+    return corpus
+
+def _run_parser (name, filename, queue):
+    from Concept import Corpus, iter_mmi
+    start = time.perf_counter()
+    if name == 'legacy list':
+        with open(filename, encoding = 'utf-8') as f:
+            count = len(legacy_corpus(f))
+    elif name == 'Corpus.fromFile':
+        with open(filename, encoding = 'utf-8') as f:
+            count = len(Corpus.fromFile(f))
+    else:
+        count = 0
+        with open(filename, 'rb') as f:
+            for concept in iter_mmi(f):
+                count += 1
+    elapsed = time.perf_counter() - start
+    queue.put((count, elapsed, utils.peak_rss() or 0))
+
+# MMI parsing speed (lines/s) and peak memory, each parser in a separate process
+def bench_mmi (filename = None):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if filename is None:
+            filename = tmpdir + '/metamap.mmi'
+            synthetic_mmi(filename, 500000)
+        with open(filename, 'rb') as f:
+            lines = sum(1 for line in f)
+        print('MMI parser, %d lines' % lines)
+        print('%16s %10s %12s %14s' % ('parser', 'time (s)', 'lines/s', 'peak RSS (MB)'))
+        for name in ('legacy list', 'Corpus.fromFile', 'iter_mmi stream'):
+            queue = multiprocessing.Queue()
+            proc = multiprocessing.Process(target = _run_parser, args = (name, filename, queue))
+            proc.start()
+            count, elapsed, peak = queue.get()
+            proc.join()
+            print('%16s %10.3f %12.0f %14.1f' % (name, elapsed, lines / elapsed, peak))
+
+# loading a vector column: per-row .npy blobs (old format) vs compact column read vs memory-mapped sidecar store
+def bench_vectors (rows = 50000):
+    import os
+    import numpy as np
+    rows = int(rows)
+    vectors = np.random.default_rng(0).standard_normal((rows, 200)).astype(np.float32)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        sizes = {}
+        for fmt in ('npy', 'compact'):
+            dbcon = sqlite3.connect(tmpdir + '/' + fmt + '.db')
+            dbcon.execute('CREATE TABLE concepts (id INTEGER PRIMARY KEY, longvec ARRAY)')
+            adapt = utils.adapt_array if fmt == 'npy' else utils.adapt_vector
+            utils.db_writeChunks(dbcon, 'INSERT INTO concepts VALUES (?, ?)', ((i + 1, adapt(vec)) for i, vec in enumerate(vectors)))
+            dbcon.close()
+            sizes[fmt] = os.path.getsize(tmpdir + '/' + fmt + '.db') / 2**20
+        print('vector column load, %d x %d float32 vectors' % vectors.shape)
+        print('%22s %10s %12s' % ('method', 'time (s)', 'DB size (MB)'))
+        dbcon = sqlite3.connect(tmpdir + '/npy.db')
+        load = lambda: np.vstack([utils.convert_array(row[0]) for row in dbcon.execute('SELECT longvec FROM concepts ORDER BY id')])
+        assert np.array_equal(load(), vectors), 'npy load mismatch'
+        print('%22s %10.3f %12.1f' % ('per-row .npy', timeit(load), sizes['npy']))
+        dbcon.close()
+        dbcon = sqlite3.connect(tmpdir + '/compact.db')
+        dbcon.execute('CREATE TABLE vectorColumns (tablename TEXT NOT NULL, colname TEXT NOT NULL, dtype TEXT, dim INTEGER, PRIMARY KEY (tablename, colname))')
+        utils.db_setVectorDim(dbcon, 'concepts', 'longvec', vectors.shape[1])
+        assert np.array_equal(utils.db_readVectors(dbcon, 'concepts', 'longvec')[1], vectors), 'compact load mismatch'
+        print('%22s %10.3f %12.1f' % ('compact db_readVectors', timeit(utils.db_readVectors, dbcon, 'concepts', 'longvec'), sizes['compact']))
+        store = utils.VectorStore.build(dbcon, 'concepts', 'longvec', tmpdir + '/longvec')
+        dbcon.close()
+        ids = np.random.default_rng(1).choice(store.ids, 1000)
+        assert np.array_equal(store.get(ids), vectors[ids - 1]), 'sidecar mismatch'
+        print('%22s %10.3f' % ('sidecar open + sum', timeit(lambda: utils.VectorStore(tmpdir + '/longvec').matrix.sum(axis = 0))))
+        print('%22s %10.4f' % ('sidecar 1000 lookups', timeit(store.get, ids)))
+        del store
+
+# blocked top-k cosine similarity search over objective shortvecs, peak memory stays far below the full similarity matrix
+def bench_similarity (rows = 20000):
+    import numpy as np
+    from objective_vectors import topk_similar
+    rows = int(rows)
+    vectors = np.random.default_rng(0).standard_normal((rows, 50)).astype(np.float32)
+    print('top-5 cosine similarity search, %d x %d vectors (full matrix would be %.0f MB)' % (rows, vectors.shape[1], rows * rows * 4 / 2**20))
+    print('%12s %10s %12s %14s' % ('block cells', 'time (s)', 'queries/s', 'peak RSS (MB)'))
+    for maxcells in (2**20, 2**22, 2**25):
+        utils.reset_peak_rss()
+        start = time.perf_counter()
+        topk_similar(vectors, vectors, 5, exclude_self = True, maxcells = maxcells)
+        elapsed = time.perf_counter() - start
+        print('%12d %10.3f %12.0f %14.1f' % (maxcells, elapsed, rows / elapsed, utils.peak_rss() or 0))
+
+# fill database with synthetic objectives (60 modules), concepts, objMap (8 concepts per objective, Zipf-like frequencies) and AVmap rows
+# return: objMap concept ids
+def synthetic_db (dbcon, objectives, seed = 0):
+    import numpy as np
+    rnd = np.random.default_rng(seed)
+    modules = rnd.integers(0, 60, objectives)
+    utils.db_writeChunks(dbcon, 'INSERT INTO objectives (id, course, module, discipline, code, objective) VALUES (?, ?, ?, ?, ?, ?)',
+                         ((i + 1, 'c' + str(m % 5), 'm' + str(m), 'd' + str(m % 12), 'LO' + str(i), 'objective') for i, m in enumerate(modules.tolist())))
+    utils.db_writeChunks(dbcon, 'INSERT INTO concepts (id, cui, token) VALUES (?, ?, ?)', ((i + 1, 'C%07d' % (i + 1), 'token') for i in range(20000)))
+    conceptids = np.minimum(rnd.zipf(1.3, objectives * 8), 20000)
+    utils.db_writeChunks(dbcon, 'INSERT INTO objMap (objid, sentence, conceptid) VALUES (?, 0, ?)',
+                         ((i // 8 + 1, c) for i, c in enumerate(conceptids.tolist())))
+    blooms = rnd.integers(1, 7, objectives * 2)
+    utils.db_writeChunks(dbcon, 'INSERT INTO AVmap (objid, sentence, AVid, verb, bloom) VALUES (?, ?, ?, ?, ?)',
+                         ((i // 2 + 1, i % 2, int(b), 'verb' + str(b), float(b)) for i, b in enumerate(blooms.tolist())))
+    return conceptids
+
+# curriculum overlap reports from the cached sparse incidence matrix vs SQL (shared concepts of all module pairs)
+def bench_overlap (objectives = 100000):
+    import numpy as np
+    import curriculum_overlap as co
+    objectives = int(objectives)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dbcon = sqlite3.connect(tmpdir + '/semantics.db')
+        utils.createTables(dbcon)
+        conceptids = synthetic_db(dbcon, objectives)
+        print('curriculum overlap, %d objectives, %d objMap rows, 60 modules' % (objectives, len(conceptids)))
+        print('%28s %10s' % ('step', 'time (s)'))
+        sql = ('WITH mc AS (SELECT DISTINCT o.module, m.conceptid FROM objMap m JOIN objectives o ON o.id = m.objid) '
+               'SELECT a.module, b.module, COUNT(*) FROM mc a JOIN mc b ON a.conceptid = b.conceptid GROUP BY a.module, b.module')
+        start = time.perf_counter()
+        expected = dict(((a, b), n) for a, b, n in dbcon.execute(sql))
+        print('%28s %10.3f' % ('SQL shared concepts', time.perf_counter() - start))
+        cachefile = tmpdir + '/incidence.npz'
+        for step in ('build incidence matrix', 'load cached matrix'):
+            start = time.perf_counter()
+            incidence, labels = co.load_incidence(dbcon, cachefile)
+            print('%28s %10.3f' % (step, time.perf_counter() - start))
+        start = time.perf_counter()
+        groups = incidence.group(labels['module'])
+        shared = co.cooccurrence(groups)
+        overlap = co.jaccard(shared)
+        unique = co.unique_concepts(groups)
+        print('%28s %10.3f' % ('group + reports', time.perf_counter() - start))
+        assert all(shared[i, j] == expected.get((a, b), 0) for i, a in enumerate(groups.rows) for j, b in enumerate(groups.rows)), 'shared concepts mismatch'
+        dbcon.close()
+
+# analysis and pipeline queries before (schema version 5, default connection settings) and after indexes and pragmas (schema.py)
+def bench_queries (objectives = 100000):
+    import schema
+    objectives = int(objectives)
+    rnd = random.Random(0)
+    objids = [(rnd.randint(1, objectives),) for i in range(1000)]
+    cuis = [('C%07d' % rnd.randint(1, 200),) for i in range(100)]
+    queries = [
+        ('R analysis join', 'SELECT objectives.course, objectives.module, objectives.discipline, AVmap.verb, AVmap.bloom FROM objectives LEFT JOIN AVmap ON objectives.id = AVmap.objid ORDER BY objectives.id, AVmap.sentence', None),
+        ('Bloom mean by module', 'SELECT o.module, AVG(a.bloom), COUNT(a.bloom) FROM objectives o JOIN AVmap a ON a.objid = o.id GROUP BY o.module', None),
+        ('concepts by module', 'SELECT o.module, m.conceptid, COUNT(*) FROM objMap m JOIN objectives o ON o.id = m.objid GROUP BY o.module, m.conceptid', None),
+        ('incidence matrix', 'SELECT objid, conceptid, COUNT(*) FROM objMap GROUP BY objid, conceptid ORDER BY objid, conceptid', None),
+        ('objMap of 1000 objectives', 'SELECT conceptid, COUNT(*) FROM objMap WHERE objid = ? GROUP BY conceptid', objids),
+        ('objectives of 100 CUIs', 'SELECT o.code FROM concepts c JOIN objMap m ON m.conceptid = c.id JOIN objectives o ON o.id = m.objid WHERE c.cui = ?', cuis),
+    ]
+    def run (dbcon, sql, params):
+        for args in (params or [()]):
+            dbcon.execute(sql, args).fetchall()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dbfile = tmpdir + '/semantics.db'
+        dbcon = sqlite3.connect(dbfile)
+        schema.migrate(dbcon, 5)
+        synthetic_db(dbcon, objectives)
+        dbcon.close()
+        times = {}
+        for label in ('before', 'after'):
+            dbcon = sqlite3.connect(dbfile)
+            if label == 'after':
+                utils.createTables(dbcon)
+            times[label] = [timeit(run, dbcon, sql, params) for name, sql, params in queries]
+            dbcon.close()
+    print('queries, %d objectives, %d objMap rows' % (objectives, objectives * 8))
+    print('%26s %11s %11s %9s' % ('query', 'before (s)', 'after (s)', 'speedup'))
+    for (name, sql, params), before, after in zip(queries, times['before'], times['after']):
+        print('%26s %11.4f %11.4f %8.1fx' % (name, before, after, before / after))
+
+benchmarks = {'replace': bench_replace, 'actverbs': bench_actverbs, 'metamap': bench_metamap, 'mmi': bench_mmi, 'vectors': bench_vectors, 'similarity': bench_similarity, 'overlap': bench_overlap, 'queries': bench_queries}
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(benchmarks)
+    for name in names:
+        name, sep, arg = name.partition(':')
+        benchmarks[name](*([arg] if arg else []))
@@ -0,0 +1,123 @@
+# Summary statistics of action verb Bloom levels (AVmap.bloom) by course, module and discipline, as materialized summary tables
+# for analysisAV.R and dashboards: mean, sd, n and 95% CI per group, same as summaryByFactor in analysisAV.R.
+# Only the primary action verb of each sentence is counted (AVmap.verbnum = 0), so n counts sentences with action verbs and
+# sentences with coordinated action verbs ('list, describe and analyse') are not weighted more.
+#   bloomObjStats: n, sum and sum of squares of the Bloom levels of each objective, with its group labels (one row per objective)
+#   bloomStats: n, sum, sum of squares, mean, sd and ci95 per grouping (all, course, module, discipline) and group label
+# Updates are incremental: objectives whose action verbs were recomputed (avhash changed), whose course, module or discipline
+# changed, or that were removed are subtracted from their old groups, new and changed objectives are added. Called by extract_actionverbs.py after the AVmap update.
+#
+# usage: python bloom_summary.py [--rebuild]
+#   --rebuild: recompute all summary tables from scratch
+#
+# Stephan Bandelow, January 2024
+
+db_file = 'semantics.db'    # database file
+
+import sqlite3
+import argparse
+import numpy as np
+import utils
+
+GROUPINGS = ('all', 'course', 'module', 'discipline')
+Z95 = 1.959963984540054     # qnorm(0.975)
+
+# n, sum and sum of squares per group label for each grouping, one vectorized pass over the labels
+# labels: dict grouping -> label array, stats: n, total, sumsq arrays (one entry per labelled row)
+# return: dict (grouping, label) -> [n, total, sumsq]
+def group_sums (labels, n, total, sumsq):
+    sums = {}
+    for grouping in GROUPINGS:
+        groups, inverse = np.unique(labels[grouping], return_inverse = True)
+        columns = [np.bincount(inverse, weights = values, minlength = len(groups)) for values in (n, total, sumsq)]
+        for group, gn, gtotal, gsumsq in zip(groups.tolist(), *columns):
+            sums[(grouping, group)] = [gn, gtotal, gsumsq]
+    return sums
+
+# per objective Bloom level stats of rows (objid, avhash, course, module, discipline, bloom) sorted by objid (bloom NULL: no action verb)
+# return: objective rows (objid, avhash, course, module, discipline, n, total, sumsq)
+def objective_sums (rows):
+    if not rows:
+        return []
+    objids = np.array([row[0] for row in rows], dtype = np.int64)
+    bloom = np.array([np.nan if row[5] is None else row[5] for row in rows], dtype = np.float64)
+    valid = ~np.isnan(bloom)
+    bloom[~valid] = 0
+    uniq, starts = np.unique(objids, return_index = True)
+    n = np.add.reduceat(valid.astype(np.int64), starts)
+    total = np.add.reduceat(bloom, starts)
+    sumsq = np.add.reduceat(bloom * bloom, starts)
+    return [tuple(rows[start][:5]) + (int(cn), float(ct), float(cs)) for start, cn, ct, cs in zip(starts.tolist(), n, total, sumsq)]
+
+# add (sign = 1) or subtract (sign = -1) objective stats rows to group sums in deltas
+def add_objectives (deltas, objrows, sign):
+    if not objrows:
+        return
+    labels = {'all': np.array([''] * len(objrows))}
+    for idx, grouping in enumerate(GROUPINGS[1:]):
+        labels[grouping] = np.array([row[2 + idx] for row in objrows], dtype = str)
+    stats = [np.array([row[col] for row in objrows], dtype = np.float64) for col in (5, 6, 7)]
+    for key, sums in group_sums(labels, *stats).items():
+        old = deltas.setdefault(key, [0, 0.0, 0.0])
+        for i in range(3):
+            old[i] += sign * sums[i]
+
+# mean, sd (n - 1) and 95% CI from n, sum and sum of squares (None where undefined, like R)
+def group_stats (n, total, sumsq):
+    mean = total / n if n > 0 else None
+    sd = ci95 = None
+    if n > 1:
+        sd = (max(sumsq - total * total / n, 0.0) / (n - 1)) ** 0.5
+        ci95 = Z95 * sd / n ** 0.5
+    return mean, sd, ci95
+
+# update summary tables for objectives with new, recomputed or removed action verbs (all objectives if rebuild)
+# return: number of objectives removed from and added to the summaries
+def update_summaries (conn, rebuild = False):
+    if rebuild:
+        conn.execute('DELETE FROM bloomObjStats')
+        conn.execute('DELETE FROM bloomStats')
+    # objectives summarized from outdated action verbs (avhash changed) or under changed labels, or removed objectives
+    stale = utils.db_readSQL(conn, 'SELECT s.objid, s.avhash, s.course, s.module, s.discipline, s.n, s.total, s.sumsq FROM bloomObjStats s '
+                                   'LEFT JOIN objectives o ON o.id = s.objid WHERE o.avhash IS NOT s.avhash OR o.course IS NOT s.course '
+                                   'OR o.module IS NOT s.module OR o.discipline IS NOT s.discipline')
+    deltas = {}
+    add_objectives(deltas, stale, -1)
+    conn.executemany('DELETE FROM bloomObjStats WHERE objid = ?', [(row[0],) for row in stale])
+    # objectives with action verbs that are not summarized yet
+    sql = ('SELECT o.id, o.avhash, o.course, o.module, o.discipline, a.bloom FROM objectives o LEFT JOIN AVmap a ON a.objid = o.id AND a.verbnum = 0 '
+           'WHERE o.avhash IS NOT NULL AND o.id NOT IN (SELECT objid FROM bloomObjStats) ORDER BY o.id')
+    added = objective_sums(utils.db_readSQL(conn, sql))
+    add_objectives(deltas, added, 1)
+    conn.executemany('INSERT INTO bloomObjStats (objid, avhash, course, module, discipline, n, total, sumsq) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', added)
+
+    # apply group deltas, recompute derived stats of changed groups, drop groups without Bloom levels
+    current = dict(((row[0], row[1]), row[2:]) for row in conn.execute('SELECT grouping, label, n, total, sumsq FROM bloomStats'))
+    rows = []
+    for key, delta in deltas.items():
+        n, total, sumsq = [old + change for old, change in zip(current.get(key, (0, 0.0, 0.0)), delta)]
+        n = int(round(n))
+        if n <= 0:
+            conn.execute('DELETE FROM bloomStats WHERE grouping = ? AND label = ?', key)
+        else:
+            rows.append(key + (n, total, sumsq) + group_stats(n, total, sumsq))
+    sql = ('INSERT INTO bloomStats (grouping, label, n, total, sumsq, mean, sd, ci95) VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (grouping, label) DO UPDATE SET '
+           'n = excluded.n, total = excluded.total, sumsq = excluded.sumsq, mean = excluded.mean, sd = excluded.sd, ci95 = excluded.ci95')
+    conn.executemany(sql, rows)
+    conn.commit()
+    return len(stale), len(added)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Update Bloom level summary tables (bloomStats) by course, module and discipline.')
+    parser.add_argument('--rebuild', action = 'store_true', help = 'recompute all summary tables from scratch')
+    args = parser.parse_args()
+
+    dbcon = sqlite3.connect(db_file)
+    utils.createTables (dbcon)
+    removed, added = update_summaries(dbcon, args.rebuild)
+    print ('Bloom level summaries: ' + str(removed) + ' objectives removed, ' + str(added) + ' added.')
+    for grouping in GROUPINGS:
+        count = dbcon.execute('SELECT COUNT(*) FROM bloomStats WHERE grouping = ?', (grouping,)).fetchone()[0]
+        print ('  ' + grouping + ': ' + str(count) + ' groups')
+    dbcon.close()
@@ -0,0 +1,185 @@
+# Curriculum concept overlap: objectives x concepts incidence matrix from objMap (sparse, CSR layout), grouped by course, module or
+# discipline, with co-occurrence (shared concepts), Jaccard overlap and unique concept reports between groups.
+# This script relies on tables objectives, objMap and concepts being filled via extract_actionverbs.py and map_concepts_metamap.py.
+# The incidence matrix is cached on disk (incidence.npz) and rebuilt only when objectives, objMap or concepts have changed (utils.db_dataVersion),
+# or when the cache was built from another database.
+#
+# usage: python curriculum_overlap.py [--by module] [--top 20]
+#   --by: group objectives by course, module or discipline (default module)
+#   --top: number of most overlapping group pairs to print (default 20)
+# output: overlap_<by>.csv (shared concepts and Jaccard overlap of all group pairs), uniqueConcepts_<by>.csv (concepts found in one group only)
+#
+# Stephan Bandelow, January 2024
+
+db_file = 'semantics.db'            # database file
+cache_file = 'incidence.npz'        # incidence matrix cache
+
+import os
+import csv
+import time
+import sqlite3
+import argparse
+import numpy as np
+import utils
+
+GROUP_COLUMNS = ('course', 'module', 'discipline')
+
+# sparse matrix in CSR layout: row r has values data[indptr[r]:indptr[r+1]] in columns indices[indptr[r]:indptr[r+1]] (sorted)
+# rows: row labels (objective ids or group names), columns: column labels (concept ids)
+class CSRMatrix:
+    def __init__(self, rows, columns, indptr, indices, data):
+        self.rows = rows
+        self.columns = columns
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+
+    @property
+    def shape(self):
+        return (len(self.rows), len(self.columns))
+
+    @property
+    def nnz(self):
+        return len(self.indices)
+
+    # build from (row index, column index, value) arrays, duplicate entries are summed
+    @classmethod
+    def from_coo (cls, rows, columns, rowidx, colidx, values):
+        keys = rowidx.astype(np.int64) * len(columns) + colidx
+        keys, inverse = np.unique(keys, return_inverse = True)
+        data = np.bincount(inverse, weights = values, minlength = len(keys)).astype(np.int32)
+        indptr = np.searchsorted(keys // max(len(columns), 1), np.arange(len(rows) + 1)).astype(np.int64)
+        return cls(rows, columns, indptr, (keys % max(len(columns), 1)).astype(np.int32), data)
+
+    # row index of each stored value
+    def row_indices (self):
+        return np.repeat(np.arange(len(self.rows)), np.diff(self.indptr))
+
+    # sum rows with the same label (labels: one per row), e.g. objectives -> modules
+    def group (self, labels):
+        groups, rowgroup = np.unique(np.asarray(labels), return_inverse = True)
+        return CSRMatrix.from_coo(groups, self.columns, rowgroup[self.row_indices()], self.indices, self.data)
+
+    # number of rows each column occurs in
+    def column_counts (self):
+        return np.bincount(self.indices, minlength = len(self.columns))
+
+    def todense (self, dtype = np.int32):
+        dense = np.zeros(self.shape, dtype = dtype)
+        dense[self.row_indices(), self.indices] = self.data
+        return dense
+
+    def save (self, filename, **extra):
+        np.savez(filename, rows = self.rows, columns = self.columns, indptr = self.indptr, indices = self.indices, data = self.data, **extra)
+
+# objectives x concepts incidence matrix (values: number of objMap rows), and objective group labels
+def incidence_from_db (dbcon, blocksize = 100000):
+    objids = np.fromiter((row[0] for row in dbcon.execute('SELECT id FROM objectives ORDER BY id')), dtype = np.int64)
+    conceptIds = np.fromiter((row[0] for row in dbcon.execute('SELECT id FROM concepts ORDER BY id')), dtype = np.int64)
+    parts = []
+    cursor = dbcon.execute('SELECT objid, conceptid, COUNT(*) FROM objMap GROUP BY objid, conceptid ORDER BY objid, conceptid')
+    rows = cursor.fetchmany(blocksize)
+    while rows:
+        parts.append(np.array(rows, dtype = np.int64).reshape(-1, 3))
+        rows = cursor.fetchmany(blocksize)
+    coo = np.concatenate(parts) if parts else np.zeros((0, 3), dtype = np.int64)
+    rowidx = np.searchsorted(objids, coo[:, 0])
+    colidx = np.searchsorted(conceptIds, coo[:, 1])
+    keep = (rowidx < len(objids)) & (colidx < len(conceptIds))
+    keep[keep] = (objids[rowidx[keep]] == coo[keep, 0]) & (conceptIds[colidx[keep]] == coo[keep, 1])
+    matrix = CSRMatrix.from_coo(objids, conceptIds, rowidx[keep], colidx[keep], coo[keep, 2])
+    labels = dict((name, []) for name in GROUP_COLUMNS)
+    for row in dbcon.execute('SELECT ' + ', '.join(GROUP_COLUMNS) + ' FROM objectives ORDER BY id'):
+        for name, value in zip(GROUP_COLUMNS, row):
+            labels[name].append(value)
+    return matrix, dict((name, np.array(values, dtype = str)) for name, values in labels.items())
+
+# cache key of the incidence matrix: database file (path and file identity), data version counters of objectives and objMap,
+# number of concepts. None for in-memory databases (not cached)
+def incidence_key (dbcon):
+    path = dbcon.execute('PRAGMA database_list').fetchone()[2]
+    if not path:
+        return None
+    version = utils.db_dataVersion(dbcon, ('objectives', 'objMap'))
+    concepts = dbcon.execute('SELECT COUNT(*) FROM concepts').fetchone()[0]
+    return '|'.join([os.path.abspath(path), str(os.stat(path).st_ino)] + [str(value) for value in version] + [str(concepts)])
+
+# incidence matrix and group labels from cache file, rebuilt if the cache is missing, was built from another database, or objectives,
+# objMap or concepts have changed
+def load_incidence (dbcon, filename = cache_file):
+    key = incidence_key(dbcon)
+    if key is not None and os.path.exists(filename):
+        with np.load(filename) as f:
+            if 'key' in f and str(f['key']) == key:
+                matrix = CSRMatrix(f['rows'], f['columns'], f['indptr'], f['indices'], f['data'])
+                return matrix, dict((name, f['label_' + name]) for name in GROUP_COLUMNS)
+    matrix, labels = incidence_from_db(dbcon)
+    if key is not None:
+        matrix.save(filename, key = np.array(key), **dict(('label_' + name, values) for name, values in labels.items()))
+    return matrix, labels
+
+
+############## group overlap reports ##################
+
+# number of concepts shared by each pair of groups (groups x groups, diagonal: concepts per group)
+# product of the binary groups x concepts matrix with its transpose, in dense blocks of blocksize concepts
+def cooccurrence (groups, blocksize = 4096):
+    rowidx = groups.row_indices()
+    shared = np.zeros((len(groups.rows), len(groups.rows)), dtype = np.int64)
+    for start in range(0, len(groups.columns), blocksize):
+        sel = (groups.indices >= start) & (groups.indices < start + blocksize)
+        block = np.zeros((len(groups.rows), min(blocksize, len(groups.columns) - start)), dtype = np.float32)
+        block[rowidx[sel], groups.indices[sel] - start] = 1
+        shared += (block @ block.T).round().astype(np.int64)
+    return shared
+
+# Jaccard overlap of the concept sets of each pair of groups (shared / union)
+def jaccard (shared):
+    sizes = np.diag(shared)
+    union = sizes[:, None] + sizes[None, :] - shared
+    return np.divide(shared, union, out = np.zeros(shared.shape), where = union > 0)
+
+# concepts that occur in one group only: list of (group index, concept index, number of objMap rows)
+def unique_concepts (groups):
+    counts = groups.column_counts()
+    rowidx = groups.row_indices()
+    unique = counts[groups.indices] == 1
+    return list(zip(rowidx[unique].tolist(), groups.indices[unique].tolist(), groups.data[unique].tolist()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Concept overlap between curriculum courses, modules or disciplines.')
+    parser.add_argument('--by', choices = GROUP_COLUMNS, default = 'module', help = 'group objectives by')
+    parser.add_argument('--top', type = int, default = 20, help = 'number of most overlapping group pairs to print')
+    args = parser.parse_args()
+
+    dbcon = sqlite3.connect(db_file)
+    utils.createTables (dbcon)
+
+    start = time.perf_counter()
+    incidence, labels = load_incidence(dbcon)
+    groups = incidence.group(labels[args.by])
+    shared = cooccurrence(groups)
+    overlap = jaccard(shared)
+    unique = unique_concepts(groups)
+    print ('Incidence matrix: %d objectives x %d concepts, %d entries; %d %ss, %d unique concepts (%.2f s).'
+           % (incidence.shape[0], incidence.shape[1], incidence.nnz, len(groups.rows), args.by, len(unique), time.perf_counter() - start))
+
+    pairs = [(i, j) for i in range(len(groups.rows)) for j in range(i + 1, len(groups.rows))]
+    pairs.sort(key = lambda pair: -overlap[pair])
+    with open('overlap_' + args.by + '.csv', 'w', encoding = 'UTF8', newline = '') as f:
+        writer = csv.writer(f)
+        writer.writerow([args.by + '1', args.by + '2', 'concepts1', 'concepts2', 'shared', 'jaccard'])
+        for i, j in pairs:
+            writer.writerow([groups.rows[i], groups.rows[j], shared[i, i], shared[j, j], shared[i, j], '%.4f' % overlap[i, j]])
+    for i, j in pairs[:args.top]:
+        print ('%.3f %s / %s: %d shared concepts' % (overlap[i, j], groups.rows[i], groups.rows[j], shared[i, j]))
+
+    concepts = dict((row[0], row[1:]) for row in dbcon.execute('SELECT id, cui, prefName FROM concepts'))
+    with open('uniqueConcepts_' + args.by + '.csv', 'w', encoding = 'UTF8', newline = '') as f:
+        writer = csv.writer(f)
+        writer.writerow([args.by, 'cui', 'prefName', 'repeats'])
+        for group, col, repeats in unique:
+            writer.writerow([groups.rows[group]] + list(concepts[int(groups.columns[col])]) + [repeats])
+
+    dbcon.close()
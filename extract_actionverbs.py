@@ -2,91 +2,228 @@
 # The objectives should be in full sentence format, parsing relies on syntactic structure.
 # An example learning objectives file is included. This script relies on this column layout:
 # id, course, module, discipline, lecture code, lecture title, objective code, objective text
-# If you use a different column layout, please adjust the script below (row 98, 99, 115 and the database schema).
+# If you use a different column layout, please adjust the script below (functions clean_rows, unique_rows and the database schema).
+#
+# usage: python extract_actionverbs.py [--workers N] [--incremental]
+#   --workers N: number of worker processes for action verb extraction (default 1 = serial, 0 = all CPU cores)
+#   --incremental: update an existing database, only new or changed objectives are processed, objectives no longer in the input file are removed
+# The steps (ingest_objectives, update_actverbs) take an optional utils.StageProfiler, benchmark_pipeline.py runs them with one.
 #
 # Stephan Bandelow, January 2024
 
 objectives_file = 'objectives.csv'  # learning objectives file (in csv fomat)
+db_file = 'curriculum.db'           # database file
+cache_file = 'cache.db'             # sentence splitting cache, shared with map_concepts_metamap.py
+chunksize = 500                     # objectives per worker task in parallel action verb extraction
 
+import os
 import csv
 import sqlite3
+import argparse
 import numpy as np
-from itertools import chain
+from functools import partial
+from collections import deque
+from multiprocessing import Pool
 import utils    # local utility functions
+import schema
+import bloom_summary
 
-    
-# database connection
-dbcon = sqlite3.connect('curriculum.db', detect_types=sqlite3.PARSE_DECLTYPES)
-utils.createTables (dbcon)    # create all necessary database tables if they don't exist already
-
-# helper dictionaries
-table_AV = utils.db_readSQL(dbcon, 'SELECT id, verb FROM actionVerbs') # action verbs from database table
-dict_AV = dict((row[1], idx) for idx, row in enumerate(table_AV))  # dict with database IDs, keyed by action verbs (for fast verb lookup)
-dict_RPL = dict(utils.db_readSQL(dbcon, 'SELECT token, replace FROM replaceMap')) # token replacement dictionary from table replaceMap
 dict_PREP = {"\n": "", "\"": "", "\'": "", "  ": " ", "\t": " ", "\u200b": "", "\u2011": "", "\u2010": "", "\u202f": "", "\u0394": ""} #remap dictionary for pre-processing all fields (strip newlines, remove quotes, double to single space, tab to space, strip unknown unicode chars)
+rpl_PREP = utils.Replacer(dict_PREP)    # compiled replacer, same output as the plain dictionary but only replace tokens found in text
+
+# action verb matcher and sentence cache for action verb extraction, loaded once per process (main process or pool worker)
+matcher = sentcache = None
+
+def load_dictionaries (dbfile):
+    global matcher
+    dbcon = sqlite3.connect(dbfile)
+    table_AV = utils.db_readSQL(dbcon, 'SELECT id, verb, bloom FROM actionVerbs') # action verbs from database table
+    dict_RPL = dict(utils.db_readSQL(dbcon, 'SELECT token, replace FROM replaceMap')) # token replacement dictionary from table replaceMap
+    matcher = utils.ActionVerbMatcher(table_AV, dict_RPL)   # compiled lexicon of action verbs, modifiers and replacement aliases
+    dbcon.close()
+
+def init_process (dbfile, cachefile):
+    global sentcache
+    load_dictionaries(dbfile)
+    sentcache = utils.SentenceCache(cachefile)
 
 
 ############## process objectives input file (csv) ##################
-header = []
-with open(objectives_file, encoding = 'utf-8') as csvfile:
-    objreader = csv.reader(csvfile, delimiter = ',', dialect = 'excel')
-    header = next(objreader)
-    objidx = header.index('objective')
-    rows = [] #container for list of lists that cointains fields by rows (2D insert data matrix for executemany)
+# rows are streamed from the csv file to the database in chunks, so memory use doesn't grow with input file size
+
+# pre-processing (cleanup) of all fields
+def clean_rows (objreader, objidx):
     for row in objreader:
         for i in range(len(row)):
-            row[i] = utils.replace_all(row[i], dict_PREP) #pre-processing (cleanup) of all fields
+            row[i] = utils.replace_all(row[i], rpl_PREP)
         row[objidx] = row[objidx].strip() #remove leading and trailing whitespace from objective text
-        rows.append(row) 
-header[0] = 'course' #clean up up 1st column name
-
-#check that we have unique objective codes and separate duplicates
-uniqueCodes = []
-dupCodes = []
-objectives = []
-for row in rows:
-    if row[5] not in uniqueCodes:
-        uniqueCodes.append(row[5])
-        objectives.append(row)
+        yield row
+
+# pass on rows with unique objective codes, write duplicates to csv file for feedback to faculty
+def unique_rows (rows, dupwriter, counts):
+    uniqueCodes = set()
+    for row in rows:
+        counts['rows'] += 1
+        if row[5] in uniqueCodes:
+            dupwriter.writerow(row)
+            counts['duplicates'] += 1
+        else:
+            uniqueCodes.add(row[5])
+            yield row
+
+# append content hash (all fields) and text hash (objective text) to rows
+def hashed_rows (rows, objidx):
+    for row in rows:
+        row.extend([utils.objective_hash(row), utils.text_hash(row[objidx])])
+        yield row
+
+# insert new and update changed objectives (by objective code), delete objectives that are no longer in the input file
+# updated objectives keep their id, their AVmap and objMap rows are recomputed only if their objective text (texthash) has changed
+def upsert_objectives (dbcon, header, rows, profiler = None):
+    counts = {'new': 0, 'changed': 0, 'removed': 0}
+    existing = dict((row[0], (row[1], row[2])) for row in dbcon.execute('SELECT code, id, hash FROM objectives'))
+    def changed_rows ():
+        for row in rows:
+            old = existing.pop(row[5], None)
+            if old is None:
+                counts['new'] += 1
+                yield row
+            elif old[1] != row[-2]:
+                counts['changed'] += 1
+                yield row
+    varnames = "', '".join(header)
+    updates = ', '.join("'" + name + "' = excluded.'" + name + "'" for name in header if name != 'code')
+    sql = "INSERT INTO objectives ('" + varnames + "') VALUES (" + ', '.join('?' * len(header)) + ") ON CONFLICT (code) DO UPDATE SET " + updates
+    utils.db_writeChunks(dbcon, sql, changed_rows(), profiler = profiler, stage = 'db objectives')
+    removed = [objid for objid, objhash in existing.values()]
+    utils.db_deleteObjMap(dbcon, removed)
+    for table, column in (('AVmap', 'objid'), ('objectives', 'id')):
+        dbcon.executemany('DELETE FROM ' + table + ' WHERE ' + column + ' = ?', [(objid,) for objid in removed])
+    dbcon.commit()
+    counts['removed'] = len(removed)
+    print ('Incremental update: ' + str(counts['new']) + ' new, ' + str(counts['changed']) + ' changed, ' + str(counts['removed']) + ' removed objectives.')
+
+# stages: csv cleaning (reading, cleaning, deduplicating and hashing rows), db objectives
+def ingest_objectives (dbcon, filename, incremental = False, dupfilename = 'duplicateObjectives.csv', profiler = None):
+    counts = {'rows': 0, 'duplicates': 0}
+    with open(filename, encoding = 'utf-8') as csvfile, open(dupfilename, 'w', encoding='UTF8', newline='') as dupfile:
+        objreader = csv.reader(csvfile, delimiter = ',', dialect = 'excel')
+        header = next(objreader)
+        objidx = header.index('objective')
+        header[0] = 'course' #clean up up 1st column name
+        dupwriter = csv.writer(dupfile)
+        dupwriter.writerow(header)
+
+        # insert unique objectives into objectives table, with content and text hash
+        rows = utils.profiled(hashed_rows(unique_rows(clean_rows(objreader, objidx), dupwriter, counts), objidx), profiler, 'csv cleaning')
+        header.extend(['hash', 'texthash'])
+        if incremental:
+            upsert_objectives(dbcon, header, rows, profiler)
+        else:
+            varnames = "', '".join(header)
+            sql = "INSERT INTO objectives ('" + varnames + "') VALUES (" + ', '.join('?' * len(header)) + ")"
+            utils.db_writeChunks(dbcon, sql, rows, profiler = profiler, stage = 'db objectives')
+    nunique = counts['rows'] - counts['duplicates']
+    print ('Found ' + str(counts['rows']) + ' objectives, ' + str(nunique) + ' unique, ' + str(counts['duplicates']) + ' duplicates.')
+
+
+############## get action verbs ##################
+
+# action verb rows (objid, sentence #, verb #, action verb ID, action verb, numeric bloom level, position) for a list of (objid, objective text)
+# one row per action verb found in a sentence (verb # 0 = primary action verb), one row without action verb for sentences without
+# stages: split sentences, action verbs (items: sentences)
+# return: AV rows, sentence cache hit/miss counts
+def objective_actverbs (objectives, profiler = None):
+    AVlist = []
+    with utils.profile_stage(profiler, 'split sentences', len(objectives)) as stage:
+        objsents = [(objid, sentcache.split (text)) for objid, text in objectives] #split into sentences (cached)
+        sentcache.commit()
+        stage['sentences'] += sum(len(sentences) for objid, sentences in objsents)
+    with utils.profile_stage(profiler, 'action verbs') as stage:
+        for objid, sentences in objsents:
+            for sentnum, verbs in enumerate(matcher.match_all(sentences)):
+                if not verbs:
+                    AVlist.append([objid, sentnum, 0, None, '', None, None])
+                for verbnum, av in enumerate(verbs):
+                    AVlist.append([objid, sentnum, verbnum, av.AVid, av.verb, av.bloom, av.position])
+            stage['items'] += len(sentences)
+    return AVlist, sentcache.reset_counts()
+
+# action verb rows for all objectives, in objective order, sentence cache counts are added to cachecounts
+# workers > 1: objectives are sharded across a process pool in chunks, each worker loads the dictionaries once at start-up.
+# Results are collected in submission order, so output is identical to the serial path. Objectives are read and
+# submitted from the calling thread (objectives can be a DB cursor), with at most 2 chunks per worker in flight.
+# The stages of objective_actverbs are recorded by profiler in the serial path only (not in pool workers).
+def extract_actverbs (objectives, cachecounts, workers = 1, dbfile = db_file, cachefile = cache_file, profiler = None):
+    if workers == 1:
+        init_process(dbfile, cachefile)
+        results = map(partial(objective_actverbs, profiler = profiler), utils.chunks(objectives, chunksize))
     else:
-        dupCodes.append(row)
-print ('Found ' + str(len(rows)) + ' objectives, ' + str(len(objectives)) + ' unique, ' + str(len(dupCodes)) + ' duplicates.')
-del(rows)
-
-# save duplicates to csv file for feedback to faculty
-with open('duplicateObjectives.csv', 'w', encoding='UTF8', newline='') as f:
-    writer = csv.writer(f)
-    writer.writerow(header)
-    writer.writerows(dupCodes)
-del(dupCodes)
-
-# insert objectives list into objectives table
-varnames = "', '".join(header)
-sql = "INSERT INTO objectives ('" + varnames + "') VALUES (?, ?, ?, ?, ?, ?, ?)"
-dbcon.executemany(sql, objectives)
-dbcon.commit()
-
-# get fresh objectives list with ID from DB
-objectives = utils.db_readSQL(dbcon, 'SELECT * FROM objectives') #get fresh objectives list with id codes for foreign key
-
-# get action verbs
-AVlist = []
-foundAV = noAV = 0
-for row in objectives:
-    sentences = utils.splitSentences (row[7]) #replace according to replace dictionary and split into sentences
-    for sentnum, sentence in enumerate(sentences):
-        av = utils.get_actverb(sentence, dict_AV, dict_RPL)
-        if(av == ''):
-            AVlist.append([row[0], sentnum, None, '', None]) #store objid, sentence #, action verb ID, action verb, numeric bloom level
-            noAV = noAV + 1
+        results = pool_results(objectives, workers, dbfile, cachefile)
+    for AVlist, counts in results:
+        for key, count in counts.items():
+            cachecounts[key] += count
+        yield from AVlist
+
+def pool_results (objectives, workers, dbfile, cachefile):
+    with Pool(workers, initializer = init_process, initargs = (dbfile, cachefile)) as pool:
+        pending = deque()
+        for chunk in utils.chunks(objectives, chunksize):
+            pending.append(pool.apply_async(objective_actverbs, (chunk,)))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+# count identified action verbs and sentences with and without action verbs while streaming AV rows to the database
+def count_actverbs (AVrows, counts):
+    for row in AVrows:
+        if row[4] == '':
+            counts['none'] += 1
         else:
-            AVlist.append(list(chain([row[0], sentnum], table_AV[dict_AV[av]]))) #store objid, sentence #, action verb ID, action verb, numeric bloom level
-            foundAV = foundAV + 1
-print (str(foundAV) + '/' + str(foundAV + noAV) + ' action verbs identified.') # 12378/13224 action verbs identified.
+            counts['verbs'] += 1
+            counts['found'] += row[2] == 0
+        yield row
+
+# action verbs of objectives whose action verbs are missing or outdated (avhash differs from text hash), written to AVmap
+# old AVmap rows are deleted first, so an interrupted run can simply be restarted
+# stages: split sentences, action verbs (serial path), db AVmap
+# return: action verb counts (found, none, verbs), sentence cache counts (hits, dbhits, misses)
+def update_actverbs (dbcon, workers = 1, dbfile = db_file, cachefile = cache_file, profiler = None):
+    dbcon.execute('DELETE FROM AVmap WHERE objid IN (SELECT id FROM objectives WHERE avhash IS NOT texthash)')
+    objectives = dbcon.execute('SELECT id, objective FROM objectives WHERE avhash IS NOT texthash ORDER BY id')
+
+    # AV map table with id - link to objective ID, sentence #, verb #, action verb id in table actionVerbs, verb, BLoom level & position in sentence
+    counts = {'found': 0, 'none': 0, 'verbs': 0}
+    cachecounts = {'hits': 0, 'dbhits': 0, 'misses': 0}
+    sql = "INSERT INTO AVmap (objid, sentence, verbnum, AVid, verb, bloom, position) VALUES (?, ?, ?, ?, ?, ?, ?)"
+    utils.db_writeChunks(dbcon, sql, count_actverbs(extract_actverbs(objectives, cachecounts, workers, dbfile, cachefile, profiler), counts), profiler = profiler, stage = 'db AVmap')
+    dbcon.execute('UPDATE objectives SET avhash = texthash WHERE avhash IS NOT texthash')
+    dbcon.commit()
+    schema.optimize(dbcon)    # query planner statistics of the new objectives and AVmap rows
+    return counts, cachecounts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Extract action verbs and Bloom levels from learning objectives.')
+    parser.add_argument('--workers', type = int, default = 1, help = 'number of worker processes for action verb extraction (default 1 = serial, 0 = all CPU cores)')
+    parser.add_argument('--incremental', action = 'store_true', help = 'update existing database, only process new or changed objectives')
+    args = parser.parse_args()
+    workers = args.workers if args.workers > 0 else os.cpu_count()
+
+    # database connection
+    dbcon = sqlite3.connect(db_file, detect_types=sqlite3.PARSE_DECLTYPES)
+    utils.createTables (dbcon)    # create all necessary database tables if they don't exist already
+
+    ingest_objectives(dbcon, objectives_file, args.incremental)
+
+    # action verbs of new objectives and objectives with changed text
+    counts, cachecounts = update_actverbs(dbcon, workers)
+    print (str(counts['found']) + '/' + str(counts['found'] + counts['none']) + ' sentences with action verbs, ' + str(counts['verbs']) + ' action verbs identified.')
+    print ('Sentence cache: ' + str(cachecounts['hits'] + cachecounts['dbhits']) + ' hits (' + str(cachecounts['dbhits']) + ' from DB), ' + str(cachecounts['misses']) + ' misses.')
 
-# AV map table with id - link to objective ID, sentence #, action verb id in table actionVerbs, verb & BLoom level
-sql = "INSERT INTO AVmap VALUES (?, ?, ?, ?, ?)"
-dbcon.executemany(sql, AVlist)
-dbcon.commit()
+    # update materialized Bloom level summaries (by course, module, discipline) for changed objectives
+    removed, added = bloom_summary.update_summaries(dbcon)
+    print ('Bloom level summaries: ' + str(removed) + ' objectives removed, ' + str(added) + ' added.')
 
-dbcon.close()
+    dbcon.close()
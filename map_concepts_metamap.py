@@ -1,86 +1,191 @@
 # Learning objectives BME recognition via MetaMap
 # This script relies on the database layout and tables being filled via scipt extract_actionverbs.py first.
 # It also relies on the NIH metamap server, and having a registered UMLS account with API keys.
-# The metamap server on the UMLS website has been discontiued since 2025. To run this script, you have to install a metamap server and call it in the script below.
+# The metamap server on the UMLS website has been discontiued since 2025. To run this script, you have to install a metamap server and set its URL (mm_url) below.
+# Sentences are submitted concurrently (metamap_client.py), metamap_standin.py provides a local stand-in server for offline tests.
+# The mapping steps (map_interactive, map_batch) take an optional utils.StageProfiler, benchmark_pipeline.py runs them with one.
 #
 # Stephan Bandelow, Janaury 2024
 
 import sqlite3
+from collections import Counter
 import utils
+import schema
 import Concept
-    
-# database connection
-dbcon = sqlite3.connect('semantics.db', detect_types=sqlite3.PARSE_DECLTYPES)
+
+db_file = 'semantics.db'    # database file
+cache_file = 'cache.db'     # sentence splitting and MetaMap response cache, shared with extract_actionverbs.py
 
 
 #################### get tokens via MetaMap ########################
-import requests
-from skr_web_api import Submission
 from Concept import Corpus  # Concept class from pymetamap MMI parser
+from metamap_client import MetaMapClient, MMICache, HTTPTransport, SubmissionTransport
+from metamap_client import MetaMapBatch, LocalBatchRunner, HTTPBatchRunner, SubmissionBatchRunner
 
+# MetaMap server: local MetaMap server URL (or metamap_standin.py for offline tests), None = NIH SKR Web API
+mm_url = None
+# batch mode: submit all pending sentences as one MetaMap batch job instead of one request per sentence
+# via local MetaMap binary (mm_binary, e.g. 'public_mm/bin/metamap'), else mm_url or NIH SKR Web API batch job
+batch_mode = False
+mm_binary = None
 # MetaMap Web API init
 email = 'none'
 apikey = 'none'
-inst = Submission(email, apikey)
 mmargs = "-y -N -R MSH,UWDA,SNOMEDCT_US,MTH,ICD10CM" # y = word sense disambiguation, N = MMI output, R = restrict lexicon: include MESH (MSH), UWDA (Digital Anatomist) and SNOMED CT US edition (SNOMEDCT_US), UMLS Metathesaurus (MTH), International Classification of Diseases, 10th Edition, Clinical Modification, 2022 (ICD10CM)
+mm_version = '2020'   # MetaMap version (part of response cache key, cached responses of other versions are dropped)
+chunksize = 200 # objectives submitted concurrently per batch
+mmichunk = 5000 # batch mode: MMI responses parsed and mapped per step
 fltPOS = {'noun', 'adj'} # filter POS for nouns and adjectives only
 
-cuis = [] # list of unique UMLS CUI codes (concept IDs)
-ucons = [] # final unique concept (tuple: DB id, CUI, semtypes, name, MeSH code, token) list for upload to table concepts
-objmap = [] # map between objectives and concepts for upload to table objMap
-objectives = utils.db_readSQL(dbcon, 'SELECT * FROM objectives') # objectives list with id codes for foreign key
-
-for objtv in objectives:
-    print ('Processing objective ' + str(objtv[0]) + ' out of ' + str(len(objectives)) + ' total.')
-    sents = utils.splitSentences (objtv[7]) # replace according to replace dictionary and split into sentences
-    sentidx = 0 # iterate by numeric index so we can repeat in case of bad request return status
-    while sentidx < len(sents):
-        inst.init_mm_interactive(sents[sentidx], args = mmargs)
-        response = inst.submit()
-        if (response.status_code != 200):
-            # no valid response, run request loop again without increasing idx
-            continue
-        else:
-            sentidx += 1
-        concepts = Corpus.fromText(response.text) #process MMI fielded list of matches
-        for concept in concepts:
-            if type(concept) == Concept.ConceptAA:
-                # metamap returned AA (abbreviations & acronyms info, need to submit expanded token to get standard MMI
-                # check first if sentence also contained expanded token, then no need to process further
-                if concept.long_form.lower() in sents[sentidx].lower():
-                    # sentence already contains expanded token, just drop abbreviation to avoid repeat
+# long forms of abbreviations (AA) in MMI concepts of sentence which the sentence doesn't contain, these are mapped separately
+# metamap returns AA (abbreviations & acronyms info) without CUI, need to submit expanded token to get standard MMI
+def missing_longforms (sent, concepts):
+    return [concept.long_form for concept in concepts if type(concept) == Concept.ConceptAA and concept.long_form.lower() not in sent.lower()]
+
+# objMap rows (objid, sentence number, concept ID, MetaMap score, trigger) of the MMI concepts of a sentence
+# expanded: MMI concepts of abbreviation long forms (long form -> Corpus), new CUIs are added to the concept registry
+def sentence_objmap (registry, objid, sentnum, sent, concepts, expanded):
+    objmap = []
+    for concept in concepts:
+        if type(concept) == Concept.ConceptAA:
+            if concept.long_form.lower() in sent.lower():
+                # sentence already contains expanded token, just drop abbreviation to avoid repeat
+                continue
+            # use result for expanded abbreviation in subsequent concept MMI eval
+            mmis = [c for c in expanded[concept.long_form] if type(c) == Concept.ConceptMMI]
+            if not mmis:
+                continue
+            concept = mmis[0]
+        if type(concept) != Concept.ConceptMMI:
+            continue    # UA (user-defined acronyms) carry no concept info
+        if concept.pos in fltPOS: # only retain concepts matching POS filter list
+            # concept ID of known CUI, new CUIs are added to the registry (id, cui, prefName, semtypes, meshcode, token)
+            concid = registry.add(concept)
+            # save objid, sentence number, tokenid, Metamap score and trigger info (from MM) to table objMap
+            objmap.append((objid, sentnum, concid, concept.score, concept.trigger))
+    return objmap
+
+# checkpoint: new concepts, objectives map and concept repeat counts of objectives in one transaction, replacing old objMap rows of changed objectives
+# repeats (count of concept occurences in objMap, to find unique and common concepts later) are updated incrementally
+# stage: db objMap (items: objMap rows)
+def write_objmap (dbcon, registry, objids, objmap, profiler = None):
+    with utils.profile_stage(profiler, 'db objMap', len(objmap)):
+        utils.db_deleteObjMap(dbcon, objids)
+        registry.flush()
+        sql = 'INSERT INTO objMap (objid, sentence, conceptid, mmscore, trigger) VALUES (?, ?, ?, ?, ?)'
+        dbcon.executemany(sql, objmap)
+        dbcon.executemany('UPDATE objectives SET mmhash = texthash WHERE id = ?', [(objid,) for objid in objids])
+        dbcon.commit()
+
+# interactive mode: sentences of each chunk of objectives (rows of table objectives) are submitted concurrently (client), then the
+# abbreviation long forms of the chunk, each chunk is written as a checkpoint
+# stages: split sentences (MetaMap), MetaMap requests, MMI parsing, concept mapping (items: sentences), db objMap
+def map_interactive (dbcon, registry, objectives, client, sentcache, profiler = None):
+    nprocessed = 0
+    for chunk in utils.chunks(objectives, chunksize):
+        nprocessed += len(chunk)
+        print ('Processing objectives up to ' + str(chunk[-1][0]) + ', ' + str(nprocessed) + ' out of ' + str(len(objectives)) + ' total.')
+        # all sentences of objectives in chunk (objective ID, sentence number, sentence), submitted concurrently, responses in same order
+        with utils.profile_stage(profiler, 'split sentences (MetaMap)', len(chunk)):
+            sents = [(objtv[0], sentnum, sent) for objtv in chunk for sentnum, sent in enumerate(sentcache.split(objtv[7]))] # split into sentences (cached)
+        with utils.profile_stage(profiler, 'MetaMap requests', len(sents)):
+            responses = client.map_texts([sent for objid, sentnum, sent in sents])
+        with utils.profile_stage(profiler, 'MMI parsing', len(responses)):
+            corpora = [Corpus.fromText(response) for response in responses] #process MMI fielded list of matches
+        # check first if sentence also contained expanded token, then no need to process further
+        longForms = list(dict.fromkeys(longForm for (objid, sentnum, sent), concepts in zip(sents, corpora) for longForm in missing_longforms(sent, concepts)))
+        with utils.profile_stage(profiler, 'MetaMap requests', len(longForms)):
+            responses = client.map_texts(longForms)
+        with utils.profile_stage(profiler, 'MMI parsing', len(responses)):
+            expanded = dict(zip(longForms, [Corpus.fromText(response) for response in responses]))
+        with utils.profile_stage(profiler, 'concept mapping', len(sents)):
+            objmap = [row for (objid, sentnum, sent), concepts in zip(sents, corpora) for row in sentence_objmap(registry, objid, sentnum, sent, concepts, expanded)] # map between objectives and concepts for upload to table objMap
+        write_objmap(dbcon, registry, [objtv[0] for objtv in chunk], objmap, profiler)
+
+# batch mode: all pending sentences (tagged objective ID.sentence number) in one batch job (batch: metamap_client.MetaMapBatch),
+# then all abbreviation long forms. MMI output is mapped by ID as it is streamed (and cached for reruns), objectives are written
+# in checkpoints of chunksize objectives once all their sentences are mapped. Sentences with abbreviations wait for the long form batch.
+# stages: split sentences (MetaMap), MetaMap batch (batch job output incl. response cache), MMI parsing, concept mapping (items: sentences), db objMap
+def map_batch (dbcon, registry, objectives, batch, sentcache, profiler = None):
+    with utils.profile_stage(profiler, 'split sentences (MetaMap)', len(objectives)):
+        sents = dict((str(objtv[0]) + '.' + str(sentnum), sent) for objtv in objectives for sentnum, sent in enumerate(sentcache.split(objtv[7])))
+    remaining = Counter(int(itemid.split('.')[0]) for itemid in sents)     # sentences per objective not mapped yet
+    objrows = {}    # objMap rows of objectives not written yet
+    waiting = {}    # MMI concepts of sentences with abbreviations, by ID
+    done = [objtv[0] for objtv in objectives if remaining[objtv[0]] == 0]   # mapped objectives not written yet
+    nwritten = 0
+    def checkpoint (objids):
+        nonlocal nwritten
+        write_objmap(dbcon, registry, objids, [row for objid in objids for row in objrows.pop(objid, [])], profiler)
+        nwritten += len(objids)
+        print ('Mapped ' + str(nwritten) + ' out of ' + str(len(objectives)) + ' objectives.')
+    for block in utils.chunks(utils.profiled(batch.run(sents.items()), profiler, 'MetaMap batch', mmichunk), mmichunk):
+        with utils.profile_stage(profiler, 'MMI parsing', len(block)):
+            block = [(itemid, Corpus.fromText(mmi)) for itemid, mmi in block]
+        ready = []  # checkpoints of objectives mapped in this block
+        with utils.profile_stage(profiler, 'concept mapping') as stage:
+            nwaiting = len(waiting)
+            for itemid, concepts in block:
+                objid, sentnum = [int(part) for part in itemid.split('.')]
+                if missing_longforms(sents[itemid], concepts):
+                    waiting[itemid] = concepts
                     continue
-                else:
-                    # look up expanded abbreviation and pass result to subsequent concept MMI eval
-                    inst.init_mm_interactive(concept.long_form, args = mmargs)
-                    response = inst.submit()
-                    concept = Corpus.fromText(response.text)[0] #process MMI fielded list of matches
-            if concept.pos in fltPOS: # only retain concepts matching POS filter list
-                if concept.cui in cuis:
-                    # duplicate CUI, find existing concept record and link to objective
-                    concid = cuis.index(concept.cui) + 1 #get concept ID
-                    # save objid, sentence number, tokenid, Metamap score and trigger info (from MM) to table objMap
-                else:
-                    # new unique CUI, add to concept list and link to objective
-                    cuis.append(concept.cui)
-                    concid = len(cuis) #auto-increment concept ID
-                    # store concept id, cui, prefName, semtypes, meshcode, token in table concepts
-                    ucons.append((concid, concept.cui, concept.preferred_name, concept.semtypes, concept.tree_codes, concept.preferred_name))
-                # save objid, sentence number, tokenid, Metamap score and trigger info (from MM) to table objMap
-                objmap.append((objtv[0], sentidx, concid, concept.score, concept.trigger))
-
-# upload objectives map and concepts table to DB
-sql = 'INSERT INTO concepts (id, cui, prefName, semtypes, meshcode, token) VALUES (?, ?, ?, ?, ?, ?)'
-dbcon.executemany(sql, ucons)
-dbcon.commit()
-sql = 'INSERT INTO objMap (objid, sentence, conceptid, mmscore, trigger) VALUES (?, ?, ?, ?, ?)'
-dbcon.executemany(sql, objmap)
-dbcon.commit()
-
-# add count of concept occurences in different objectives to objMap (to find unique and common concepts later)
-concRepeats = utils.db_readSQL(dbcon, 'SELECT COUNT(conceptid), conceptid FROM objMap GROUP BY conceptid')
-sql = 'UPDATE concepts SET repeats = ? WHERE id = ?'   
-dbcon.executemany(sql, concRepeats)
-dbcon.commit()
-
-dbcon.close()
+                objrows.setdefault(objid, []).extend(sentence_objmap(registry, objid, sentnum, sents[itemid], concepts, {}))
+                remaining[objid] -= 1
+                if remaining[objid] == 0:
+                    done.append(objid)
+                    if len(done) >= chunksize:
+                        ready.append(done)
+                        done = []
+            stage['items'] += len(block) - (len(waiting) - nwaiting)   # sentences with abbreviations are mapped after the long form batch
+        for objids in ready:
+            checkpoint(objids)
+    # abbreviation long forms in one batch job, then sentences with abbreviations
+    longForms = dict((longForm, 'AA' + str(n)) for n, longForm in enumerate(dict.fromkeys(longForm for itemid, concepts in waiting.items() for longForm in missing_longforms(sents[itemid], concepts))))
+    aaForms = dict((aaid, longForm) for longForm, aaid in longForms.items())
+    responses = list(utils.profiled(batch.run((aaid, longForm) for longForm, aaid in longForms.items()), profiler, 'MetaMap batch', mmichunk))
+    with utils.profile_stage(profiler, 'MMI parsing', len(responses)):
+        expanded = dict((aaForms[aaid], Corpus.fromText(mmi)) for aaid, mmi in responses)
+    with utils.profile_stage(profiler, 'concept mapping', len(waiting)):
+        for itemid, concepts in waiting.items():
+            objid, sentnum = [int(part) for part in itemid.split('.')]
+            objrows.setdefault(objid, []).extend(sentence_objmap(registry, objid, sentnum, sents[itemid], concepts, expanded))
+            remaining[objid] -= 1
+            if remaining[objid] == 0:
+                done.append(objid)
+    for objids in utils.chunks(done, chunksize):
+        checkpoint(objids)
+
+
+if __name__ == '__main__':
+    # database connection
+    dbcon = sqlite3.connect(db_file, detect_types=sqlite3.PARSE_DECLTYPES)
+    sentcache = utils.SentenceCache(cache_file)  # sentence splitting cache, shared with extract_actionverbs.py
+
+    transport = HTTPTransport(mm_url) if mm_url else SubmissionTransport(email, apikey)
+    # persistent response cache for sentences and abbreviation expansions, responses for other MetaMap arguments (e.g. lexicon restriction) are dropped
+    mmcache = MMICache(cache_file, version = mm_version, maxbytes = 512 * 2**20, invalidate = True, args = mmargs)
+    client = MetaMapClient(transport, mmargs, concurrency = 8, retries = 5, backoff = 0.5, timeout = 60, cache = mmcache) # concurrent requests, failed requests are retried with exponential backoff
+
+    utils.createTables (dbcon)    # add content hash columns to older databases
+    registry = utils.ConceptRegistry(dbcon) # unique UMLS CUI codes -> concept IDs, incl. concepts from previous runs
+    # objectives list with id codes for foreign key, only new objectives or objectives with changed text (mmhash differs from text hash)
+    # each chunk is committed as a checkpoint (with mmhash set), so an interrupted run continues after the last committed chunk
+    objectives = utils.db_readSQL(dbcon, 'SELECT * FROM objectives WHERE mmhash IS NOT texthash')
+
+    if batch_mode:
+        runner = LocalBatchRunner(mm_binary) if mm_binary else HTTPBatchRunner(mm_url) if mm_url else SubmissionBatchRunner(email, apikey)
+        batch = MetaMapBatch(runner, mmargs, mmcache)
+        map_batch(dbcon, registry, objectives, batch, sentcache)
+        print ('MetaMap batch: ' + str(batch.counts['submitted']) + ' texts submitted, ' + str(batch.counts['cached']) + ' cached.')
+    else:
+        map_interactive(dbcon, registry, objectives, client, sentcache)
+    print ('MetaMap: ' + str(client.counts['requests']) + ' requests, ' + str(client.counts['retries']) + ' retries, ' + str(mmcache.counts['hits']) + ' cached responses.')
+    print (str(len(registry)) + ' unique concepts.')
+    schema.optimize(dbcon)    # query planner statistics of the new objMap and concepts rows
+    mmcache.close()
+
+    counts = sentcache.reset_counts()
+    print ('Sentence cache: ' + str(counts['hits'] + counts['dbhits']) + ' hits (' + str(counts['dbhits']) + ' from DB), ' + str(counts['misses']) + ' misses.')
+    sentcache.close()
+    dbcon.close()
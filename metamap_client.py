@@ -0,0 +1,305 @@
+# Asynchronous MetaMap client: submits many texts concurrently, with bounded retries, exponential backoff and per-request timeouts.
+# The blocking HTTP calls run in a thread pool, asyncio limits concurrency and keeps results in submission order.
+#
+# Transports (callable: text, args, timeout -> status code, response text):
+#   HTTPTransport: (local) MetaMap server accepting the SKR interactive form fields, e.g. metamap_standin.py
+#   SubmissionTransport: NIH SKR web API via skr_web_api (discontinued since 2025)
+#
+# MMICache keeps raw MMI responses in SQLite, so repeated texts (reruns, common abbreviation expansions) are only submitted once.
+#
+# MetaMapBatch submits many texts as a single batch job instead (single line delimited input with IDs, --sldiID), and streams the
+# combined MMI output into the response cache. Batch runners (callable: input file name, args -> iterator of MMI output lines):
+#   LocalBatchRunner: pipe input file through a local MetaMap binary
+#   HTTPBatchRunner: post input to a MetaMap server accepting batch text (metamap_standin.py)
+#   SubmissionBatchRunner: NIH SKR web API generic batch job via skr_web_api
+#
+# Stephan Bandelow, January 2024
+
+import re
+import time
+import random
+import shlex
+import sqlite3
+import asyncio
+import hashlib
+import inspect
+import tempfile
+import subprocess
+import unicodedata
+from itertools import groupby
+from concurrent.futures import ThreadPoolExecutor
+
+class MetaMapError(Exception):
+    pass
+
+# POST SKR interactive form fields to a MetaMap server URL
+class HTTPTransport:
+    def __init__(self, url):
+        import requests
+        self.url = url
+        self.session = requests.Session()
+
+    def __call__(self, text, args, timeout):
+        form = {'RUN_PROG': 'GENERIC_V', 'Batch_Command': 'metamap ' + args, 'APIText': text}
+        response = self.session.post(self.url, data = form, timeout = timeout)
+        return response.status_code, response.text
+
+# NIH SKR web API, one Submission per request because it keeps the request form as state
+# the request timeout is passed to Submission.submit where the installed skr_web_api version accepts it
+class SubmissionTransport:
+    def __init__(self, email, apikey):
+        from skr_web_api import Submission
+        self.Submission = Submission
+        self.email = email
+        self.apikey = apikey
+        self.timeoutArg = 'timeout' in inspect.signature(Submission.submit).parameters
+
+    def __call__(self, text, args, timeout):
+        inst = self.Submission(self.email, self.apikey)
+        inst.init_mm_interactive(text, args = args)
+        response = inst.submit(timeout = timeout) if self.timeoutArg else inst.submit()
+        return response.status_code, response.text
+
+# persistent MMI response cache, content-addressed by normalized text, MetaMap arguments and MetaMap version
+# maxbytes: size limit of stored responses, least recently used responses are evicted when it is exceeded
+# invalidate: drop responses for other MetaMap versions or arguments (e.g. changed lexicon restriction) on opening
+class MMICache:
+    def __init__(self, dbfile = 'cache.db', version = '', maxbytes = 512 * 2**20, invalidate = False, args = None):
+        self.conn = sqlite3.connect(dbfile, timeout = 60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS mmi (hash TEXT PRIMARY KEY, args TEXT, version TEXT, mmi TEXT NOT NULL, size INTEGER, used REAL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS mmi_used ON mmi (used)')
+        self.version = version
+        self.maxbytes = maxbytes
+        if invalidate:
+            self.invalidate(args)
+        self.total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM mmi').fetchone()[0]
+        self.pending = {}   # new responses not yet written to DB
+        self.touched = set()    # cache hits, last use time updated on commit
+        self.counts = {'hits': 0, 'misses': 0, 'evicted': 0}
+
+    @staticmethod
+    def normalize (text):
+        return re.sub(r'\s+', ' ', unicodedata.normalize('NFC', text)).strip()
+
+    def key (self, text, args):
+        return hashlib.sha1('\0'.join((self.normalize(text), args, self.version)).encode('utf-8')).hexdigest()
+
+    # cached MMI response for text, None if not cached
+    def get (self, text, args):
+        key = self.key(text, args)
+        if key in self.pending:
+            mmi = self.pending[key][3]
+        else:
+            row = self.conn.execute('SELECT mmi FROM mmi WHERE hash = ?', (key,)).fetchone()
+            mmi = row[0] if row else None
+        if mmi is None:
+            self.counts['misses'] += 1
+        else:
+            self.counts['hits'] += 1
+            self.touched.add(key)
+        return mmi
+
+    def put (self, text, args, mmi):
+        key = self.key(text, args)
+        self.pending[key] = (key, args, self.version, mmi, len(mmi.encode('utf-8')), time.time())
+
+    # write new responses and last use times to DB, evict least recently used responses above size limit
+    def commit (self):
+        now = time.time()
+        self.conn.executemany('UPDATE mmi SET used = ? WHERE hash = ?', [(now, key) for key in self.touched if key not in self.pending])
+        # responses replaced by new ones no longer count towards the total size
+        for key in self.pending:
+            row = self.conn.execute('SELECT size FROM mmi WHERE hash = ?', (key,)).fetchone()
+            if row is not None:
+                self.total -= row[0] or 0
+        self.conn.executemany('INSERT OR REPLACE INTO mmi VALUES (?, ?, ?, ?, ?, ?)', self.pending.values())
+        self.total += sum(item[4] for item in self.pending.values())
+        self.pending = {}
+        self.touched = set()
+        if self.total > self.maxbytes:
+            self.evict(int(self.maxbytes * 0.9))
+        self.conn.commit()
+
+    def evict (self, targetbytes):
+        evicted = []
+        for key, size in self.conn.execute('SELECT hash, size FROM mmi ORDER BY used'):
+            if self.total <= targetbytes:
+                break
+            evicted.append((key,))
+            self.total -= size
+        self.conn.executemany('DELETE FROM mmi WHERE hash = ?', evicted)
+        self.counts['evicted'] += len(evicted)
+
+    # drop all responses of other MetaMap versions, and of other arguments if args is given (or all responses if clear)
+    def invalidate (self, args = None, clear = False):
+        if clear:
+            self.conn.execute('DELETE FROM mmi')
+        elif args is None:
+            self.conn.execute('DELETE FROM mmi WHERE version IS NOT ?', (self.version,))
+        else:
+            self.conn.execute('DELETE FROM mmi WHERE version IS NOT ? OR args IS NOT ?', (self.version, args))
+        self.conn.commit()
+        self.total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM mmi').fetchone()[0]
+
+    def close (self):
+        self.commit()
+        self.conn.close()
+
+class MetaMapClient:
+    # concurrency: max. requests in flight, retries: max. repeats of a failed request (non-200 status, error or timeout)
+    # backoff: wait before 1st retry in seconds, doubled for every further retry, timeout: per request in seconds
+    # cache: MMICache for responses (optional)
+    def __init__(self, transport, args, concurrency = 8, retries = 5, backoff = 0.5, timeout = 60, cache = None):
+        self.transport = transport
+        self.cache = cache
+        self.args = args
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.counts = {'requests': 0, 'retries': 0}
+
+    # MMI response text for text, raises MetaMapError when all retries failed
+    async def submit (self, text, semaphore, executor):
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                self.counts['retries'] += 1
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1) * (0.5 + random.random() / 2))    # jitter, so failed requests don't retry in lockstep
+            async with semaphore:
+                self.counts['requests'] += 1
+                try:
+                    status, response = await asyncio.wait_for(loop.run_in_executor(executor, self.transport, text, self.args, self.timeout), self.timeout)
+                except Exception as e:  # timeout, connection error
+                    error = repr(e)
+                    continue
+            if status == 200:
+                return response
+            error = 'status ' + str(status)
+        raise MetaMapError('MetaMap request failed after ' + str(self.retries + 1) + ' attempts (' + error + '): ' + text[:80])
+
+    # a timed out transport call can't be interrupted and keeps running in its thread, but no longer holds a concurrency slot:
+    # the pool has threads for retries next to stuck calls, and is shut down without waiting for them
+    async def submit_all (self, texts):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        executor = ThreadPoolExecutor(max_workers = self.concurrency * (self.retries + 1))
+        try:
+            return await asyncio.gather(*[self.submit(text, semaphore, executor) for text in texts])
+        finally:
+            executor.shutdown(wait = False, cancel_futures = True)
+
+    # MMI response texts for list of texts, in the same order
+    # repeated texts are only submitted once, cached responses are not submitted again
+    def map_texts (self, texts):
+        responses = {}
+        if self.cache is not None:
+            for text in dict.fromkeys(texts):
+                mmi = self.cache.get(text, self.args)
+                if mmi is not None:
+                    responses[text] = mmi
+        missing = [text for text in dict.fromkeys(texts) if text not in responses]
+        if missing:
+            responses.update(zip(missing, asyncio.run(self.submit_all(missing))))
+            if self.cache is not None:
+                for text in missing:
+                    self.cache.put(text, self.args, responses[text])
+        if self.cache is not None:
+            self.cache.commit()
+        return [responses[text] for text in texts]
+
+
+# pipe batch input file through local MetaMap binary, stream output lines
+class LocalBatchRunner:
+    def __init__(self, binary = 'metamap'):
+        self.binary = binary
+
+    def __call__(self, infile, args):
+        with open(infile, encoding = 'utf-8') as f:
+            proc = subprocess.Popen([self.binary] + shlex.split(args) + ['--sldiID'], stdin = f, stdout = subprocess.PIPE, text = True, encoding = 'utf-8')
+            for line in proc.stdout:
+                yield line
+            if proc.wait() != 0:
+                raise MetaMapError('MetaMap batch process failed with exit code ' + str(proc.returncode))
+
+# post batch input to MetaMap server (SKR form fields, single line delimited input with IDs), stream output lines
+class HTTPBatchRunner:
+    def __init__(self, url, timeout = 3600):
+        import requests
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def __call__(self, infile, args):
+        with open(infile, encoding = 'utf-8') as f:
+            form = {'RUN_PROG': 'GENERIC_V', 'Batch_Command': 'metamap ' + args + ' --sldiID', 'SingLinePMID': 'yes', 'APIText': f.read()}
+        with self.session.post(self.url, data = form, timeout = self.timeout, stream = True) as response:
+            if response.status_code != 200:
+                raise MetaMapError('MetaMap batch request failed with status ' + str(response.status_code))
+            response.encoding = 'utf-8'
+            yield from response.iter_lines(decode_unicode = True)
+
+# NIH SKR web API generic batch job
+class SubmissionBatchRunner:
+    def __init__(self, email, apikey):
+        from skr_web_api import Submission
+        self.Submission = Submission
+        self.email = email
+        self.apikey = apikey
+
+    def __call__(self, infile, args):
+        inst = self.Submission(self.email, self.apikey)
+        inst.init_generic_batch('metamap', args + ' --sldiID')
+        inst.set_batch_file(infile)
+        inst.form['SingLinePMID'] = True
+        response = inst.submit()
+        if response.status_code != 200:
+            raise MetaMapError('MetaMap batch request failed with status ' + str(response.status_code))
+        yield from response.text.splitlines()
+
+# MMI output lines grouped by ID (1st field), as (ID, MMI text)
+def group_mmi (lines):
+    lines = (line.rstrip('\n') for line in lines if '|' in line)
+    for itemid, group in groupby(lines, key = lambda line: line.split('|', 1)[0]):
+        yield itemid, '\n'.join(group) + '\n'
+
+class MetaMapBatch:
+    def __init__(self, runner, args, cache, commitsize = 1000):
+        self.runner = runner
+        self.args = args
+        self.cache = cache
+        self.commitsize = commitsize
+        self.counts = {'submitted': 0, 'cached': 0}
+
+    # MMI responses for items (ID, text), as (ID, MMI text) in output order
+    # cached texts are returned first, all others are written to one batch input file and submitted as a single job,
+    # output is streamed into the response cache
+    def run (self, items):
+        texts = {}
+        for itemid, text in items:
+            mmi = self.cache.get(text, self.args)
+            if mmi is None:
+                texts[itemid] = text
+            else:
+                self.counts['cached'] += 1
+                yield itemid, mmi
+        if not texts:
+            return
+        self.counts['submitted'] += len(texts)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            infile = tmpdir + '/batch.txt'
+            with open(infile, 'w', encoding = 'utf-8') as f:
+                for itemid, text in texts.items():
+                    f.write(itemid + '|' + ' '.join(text.split()) + '\n')  # single line per text
+            for n, (itemid, mmi) in enumerate(group_mmi(self.runner(infile, self.args))):
+                if itemid not in texts:
+                    continue
+                self.cache.put(texts.pop(itemid), self.args, mmi)
+                if n % self.commitsize == 0:
+                    self.cache.commit()
+                yield itemid, mmi
+        # no MetaMap output for remaining texts: no concepts
+        for itemid, text in texts.items():
+            self.cache.put(text, self.args, '')
+            yield itemid, ''
+        self.cache.commit()
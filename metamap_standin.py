@@ -0,0 +1,129 @@
+# Local stand-in for a MetaMap server, for offline testing and benchmarking of map_concepts_metamap.py.
+# Accepts the SKR interactive form fields (APIText, Batch_Command) and replies with MMI fielded output
+# (batch requests with SingLinePMID set: APIText has one 'ID|text' line per text, output lines start with the ID):
+# canned responses from a file (JSON lines with fields text and mmi), otherwise MMI lines generated from
+# the concept tokens in concepts.csv that appear in the text.
+#
+# usage: python metamap_standin.py [--port 8066] [--responses file.jsonl] [--latency 0.05] [--error-rate 0.1]
+#
+# Stephan Bandelow, January 2024
+
+import re
+import csv
+import json
+import time
+import random
+import argparse
+import threading
+from urllib.parse import parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# MMI line for a concept triggered by token at character position pos in text
+def mmi_line (concept, token, pos, score = 10.0, itemid = '00000000'):
+    trigger = '["' + token + '"-tx-1-"' + token.lower() + '"-noun-0]'
+    return '|'.join([itemid, 'MMI', '%.2f' % score, concept['preferred_name'], concept['cui'], '[' + concept['semantic_types'] + ']', trigger, 'TX', str(pos) + '/' + str(len(token)), ''])
+
+class StandinMetaMap:
+    # responses: dict of canned MMI responses by text, concepts: concepts.csv file for generated responses
+    def __init__(self, responses = None, concepts = 'concepts.csv', latency = 0.0, errorRate = 0.0, seed = 0):
+        self.responses = responses or {}
+        self.latency = latency
+        self.errorRate = errorRate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {'requests': 0, 'errors': 0}
+        self.concepts = {}
+        if concepts:
+            with open(concepts, encoding = 'utf-8') as f:
+                for row in csv.DictReader(f):
+                    self.concepts.setdefault(row['token'].lower(), row)
+        # longest tokens first, so multi-word concepts win over their parts
+        tokens = sorted(self.concepts, key = len, reverse = True)
+        self.pattern = re.compile(r'\b(' + '|'.join(re.escape(t) for t in tokens) + r')\b', re.IGNORECASE) if tokens else None
+
+    @staticmethod
+    def load_responses (filename):
+        responses = {}
+        with open(filename, encoding = 'utf-8') as f:
+            for line in f:
+                if line.strip():
+                    item = json.loads(line)
+                    responses[item['text']] = item['mmi']
+        return responses
+
+    def mmi (self, text, itemid = '00000000'):
+        if text in self.responses:
+            response = self.responses[text]
+            if itemid != '00000000':
+                response = '\n'.join(itemid + line[line.find('|'):] for line in response.splitlines() if '|' in line) + '\n'
+            return response
+        lines = []
+        if self.pattern is not None:
+            for match in self.pattern.finditer(text):
+                lines.append(mmi_line(self.concepts[match.group(1).lower()], match.group(1), match.start(), itemid = itemid))
+        return '\n'.join(lines) + '\n'
+
+    # MMI output for batch input with one 'ID|text' line per text
+    def mmi_batch (self, text):
+        output = []
+        for line in text.splitlines():
+            if '|' in line:
+                itemid, text = line.split('|', 1)
+                output.append(self.mmi(text, itemid))
+        return ''.join(output)
+
+    # status code and response text for request
+    def reply (self, text, batch = False):
+        with self.lock:
+            self.counts['requests'] += 1
+            error = self.random.random() < self.errorRate
+            if error:
+                self.counts['errors'] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if error:
+            return 503, 'Service unavailable (stand-in error)\n'
+        return 200, self.mmi_batch(text) if batch else self.mmi(text)
+
+    def handler (self):
+        standin = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                form = parse_qs(self.rfile.read(length).decode('utf-8'))
+                status, body = standin.reply(form.get('APIText', [''])[0], 'SingLinePMID' in form)
+                body = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/plain; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass    # no request logging
+        return Handler
+
+    # start server in background thread, return server (server.shutdown() to stop) and its URL
+    def serve (self, host = '127.0.0.1', port = 0):
+        server = ThreadingHTTPServer((host, port), self.handler())
+        server.daemon_threads = True
+        threading.Thread(target = server.serve_forever, daemon = True).start()
+        return server, 'http://%s:%d/' % server.server_address
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Local stand-in MetaMap server replaying canned MMI responses.')
+    parser.add_argument('--port', type = int, default = 8066)
+    parser.add_argument('--responses', help = 'canned responses file, JSON lines with fields text and mmi')
+    parser.add_argument('--latency', type = float, default = 0.0, help = 'simulated processing time per request (seconds)')
+    parser.add_argument('--error-rate', type = float, default = 0.0, help = 'fraction of requests answered with status 503')
+    args = parser.parse_args()
+
+    responses = StandinMetaMap.load_responses(args.responses) if args.responses else None
+    standin = StandinMetaMap(responses, latency = args.latency, errorRate = args.error_rate)
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), standin.handler())
+    print ('MetaMap stand-in listening on http://127.0.0.1:' + str(args.port) + '/')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
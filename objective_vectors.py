@@ -0,0 +1,200 @@
+# Objective vectors and similarity search, from the concept vectors (concepts.longvec, e.g. BioWordVec) and the objectives map (objMap).
+# This script relies on tables objMap and concepts being filled via map_concepts_metamap.py, and on concept longvecs being loaded.
+#   objectives.longvec: sum of the longvecs of all concepts mapped to the objective (one row per objMap entry)
+#   shortvec (objectives and concepts): dimensionality reduced longvec, PCA of the unit length objective longvecs
+# Similar (possibly redundant) objectives are found with a blocked top-k cosine similarity search, without building the full
+# objectives x objectives similarity matrix, and written to similarObjectives.csv for feedback to faculty.
+#
+# usage: python objective_vectors.py [--dims 50] [--top 5] [--threshold 0.9] [--text "free text" --mm-url URL]
+#   --dims: shortvec dimensions (default 50)
+#   --top: number of most similar objectives per objective (default 5)
+#   --threshold: minimum cosine similarity of objective pairs written to similarObjectives.csv (default 0.9)
+#   --text: find the objectives most similar to a free text instead (concepts mapped via MetaMap server at --mm-url)
+#
+# Stephan Bandelow, January 2024
+
+db_file = 'semantics.db'            # database file
+reduction_file = 'reduction.npz'    # fitted dimensionality reduction (applied to free text queries)
+
+import csv
+import sqlite3
+import argparse
+import numpy as np
+import utils
+
+# objective longvecs in one pass over objMap: concept vectors of mapping rows are gathered and summed per objective
+# (sparse objectives x concepts incidence matrix times dense concept matrix), objMap is read in blocks of blocksize rows
+# return: objective ids (only objectives with at least one concept vector), float32 matrix
+def objective_longvecs (dbcon, blocksize = 100000):
+    conceptIds, conceptVecs = utils.db_readVectors(dbcon, 'concepts', 'longvec')
+    objids = np.fromiter((row[0] for row in dbcon.execute('SELECT id FROM objectives ORDER BY id')), dtype = np.int64)
+    longvecs = np.zeros((len(objids), conceptVecs.shape[1]), dtype = utils.VECTOR_DTYPE)
+    found = np.zeros(len(objids), dtype = bool)
+    cursor = dbcon.execute('SELECT objid, conceptid FROM objMap ORDER BY objid')
+    rows = cursor.fetchmany(blocksize)
+    while rows:
+        block = np.array(rows, dtype = np.int64).reshape(-1, 2)
+        # keep mapping rows of known objectives with a concept vector
+        objrows = np.searchsorted(objids, block[:, 0])
+        conrows = np.searchsorted(conceptIds, block[:, 1])
+        keep = (objrows < len(objids)) & (conrows < len(conceptIds))
+        keep[keep] = (objids[objrows[keep]] == block[keep, 0]) & (conceptIds[conrows[keep]] == block[keep, 1])
+        objrows, conrows = objrows[keep], conrows[keep]
+        if len(objrows):
+            # rows are sorted by objective, sum concept vectors per objective (objectives can continue in the next block)
+            uniq, starts = np.unique(objrows, return_index = True)
+            longvecs[uniq] += np.add.reduceat(conceptVecs[conrows], starts, axis = 0)
+            found[uniq] = True
+        rows = cursor.fetchmany(blocksize)
+    return objids[found], longvecs[found]
+
+# row blocks of matrix
+def blocks (matrix, blocksize):
+    for start in range(0, len(matrix), blocksize):
+        yield matrix[start:start + blocksize]
+
+# unit length rows (zero rows stay zero)
+def normalize (matrix):
+    norms = np.linalg.norm(matrix, axis = 1, keepdims = True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+# PCA dimensionality reduction (longvec -> shortvec) of unit length vectors, fitted and applied in batches
+class Reduction:
+    def __init__(self, mean, components):
+        self.mean = mean                # mean of unit length vectors
+        self.components = components    # longvec dims x shortvec dims, largest variance first
+
+    # fit on batches of vectors (iterable of matrices), covariance is accumulated batch by batch
+    @classmethod
+    def fit (cls, batches, dims):
+        n = 0
+        total = xtx = None
+        for batch in batches:
+            batch = normalize(batch.astype(np.float64))
+            if total is None:
+                total = np.zeros(batch.shape[1])
+                xtx = np.zeros((batch.shape[1], batch.shape[1]))
+            n += len(batch)
+            total += batch.sum(axis = 0)
+            xtx += batch.T @ batch
+        if n < 2:
+            raise ValueError('Reduction: need at least 2 vectors to fit')
+        mean = total / n
+        cov = (xtx - n * np.outer(mean, mean)) / (n - 1)
+        eigvals, eigvecs = np.linalg.eigh(cov)  # ascending eigenvalues
+        components = eigvecs[:, ::-1][:, :min(dims, len(mean))]
+        return cls(mean.astype(utils.VECTOR_DTYPE), components.astype(utils.VECTOR_DTYPE))
+
+    def transform (self, matrix, blocksize = 50000):
+        out = np.empty((len(matrix), self.components.shape[1]), dtype = utils.VECTOR_DTYPE)
+        for start in range(0, len(matrix), blocksize):
+            out[start:start + blocksize] = (normalize(matrix[start:start + blocksize]) - self.mean) @ self.components
+        return out
+
+    def save (self, filename):
+        np.savez(filename, mean = self.mean, components = self.components)
+
+    @classmethod
+    def load (cls, filename):
+        with np.load(filename) as f:
+            return cls(f['mean'], f['components'])
+
+# top k cosine similarities of query vectors to matrix rows, computed in blocks of query rows (at most maxcells similarities at a time)
+# exclude_self: queries are the matrix rows themselves, skip each row's similarity to itself
+# return: row indices (queries x k, most similar first) and cosine similarities
+def topk_similar (queries, matrix, k, exclude_self = False, maxcells = 2**22):
+    matrix = normalize(matrix).astype(utils.VECTOR_DTYPE)
+    queries = matrix if exclude_self else normalize(queries).astype(utils.VECTOR_DTYPE)
+    k = min(k, len(matrix) - (1 if exclude_self else 0))
+    indices = np.empty((len(queries), k), dtype = np.int64)
+    scores = np.empty((len(queries), k), dtype = utils.VECTOR_DTYPE)
+    blocksize = max(1, maxcells // max(len(matrix), 1))
+    for start in range(0, len(queries), blocksize):
+        sims = queries[start:start + blocksize] @ matrix.T
+        rows = np.arange(len(sims))
+        if exclude_self:
+            sims[rows, start + rows] = -np.inf
+        top = np.argpartition(-sims, k - 1, axis = 1)[:, :k] if k < sims.shape[1] else np.tile(np.arange(k), (len(sims), 1))
+        order = np.argsort(-sims[rows[:, None], top], axis = 1, kind = 'stable')
+        top = top[rows[:, None], order]
+        indices[start:start + len(sims)] = top
+        scores[start:start + len(sims)] = sims[rows[:, None], top]
+    return indices, scores
+
+# pairs of similar objectives (id1 < id2, cosine similarity) above threshold, from the top k neighbours of each objective
+def similar_pairs (objids, vectors, k = 5, threshold = 0.9):
+    indices, scores = topk_similar(vectors, vectors, k, exclude_self = True)
+    pairs = {}
+    for row, col in zip(*np.nonzero(scores >= threshold)):
+        a, b = sorted((int(objids[row]), int(objids[indices[row, col]])))
+        pairs[(a, b)] = float(scores[row, col])
+    return sorted(((a, b, score) for (a, b), score in pairs.items()), key = lambda pair: -pair[2])
+
+# longvec of free text: sum of the concept vectors of the concepts MetaMap finds in the text (same POS filter as map_concepts_metamap.py)
+# return: None if no concept with a vector is found
+def text_longvec (dbcon, text, client, fltPOS = ('noun', 'adj')):
+    from Concept import Corpus, ConceptMMI
+    cuis = [concept.cui for concept in Corpus.fromText(client.map_texts([text])[0]) if type(concept) == ConceptMMI and concept.pos in fltPOS]
+    conceptIds = dict(dbcon.execute('SELECT cui, id FROM concepts WHERE longvec IS NOT NULL'))
+    ids, vecs = utils.db_readVectors(dbcon, 'concepts', 'longvec')
+    rows = np.searchsorted(ids, [conceptIds[cui] for cui in cuis if cui in conceptIds])
+    if len(rows) == 0:
+        return None
+    return vecs[rows].sum(axis = 0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Build objective vectors and find similar objectives.')
+    parser.add_argument('--dims', type = int, default = 50, help = 'shortvec dimensions')
+    parser.add_argument('--top', type = int, default = 5, help = 'number of most similar objectives per objective')
+    parser.add_argument('--threshold', type = float, default = 0.9, help = 'minimum cosine similarity of similar objective pairs')
+    parser.add_argument('--text', help = 'find objectives most similar to this text (only search, vectors are not rebuilt)')
+    parser.add_argument('--mm-url', help = 'MetaMap server URL for --text')
+    args = parser.parse_args()
+    if args.text and not args.mm_url:
+        parser.error('--text requires --mm-url')
+
+    dbcon = sqlite3.connect(db_file)
+    utils.createTables (dbcon)
+
+    if args.text:
+        from metamap_client import MetaMapClient, HTTPTransport
+        client = MetaMapClient(HTTPTransport(args.mm_url), '-y -N -R MSH,UWDA,SNOMEDCT_US,MTH,ICD10CM')
+        longvec = text_longvec(dbcon, args.text, client)
+        if longvec is None:
+            print ('No concepts found in text.')
+        else:
+            reduction = Reduction.load(reduction_file)
+            query = reduction.transform(longvec[None, :])
+            objids, shortvecs = utils.db_readVectors(dbcon, 'objectives', 'shortvec')
+            indices, scores = topk_similar(query, shortvecs, args.top)
+            for idx, score in zip(indices[0], scores[0]):
+                code, objective = dbcon.execute('SELECT code, objective FROM objectives WHERE id = ?', (int(objids[idx]),)).fetchone()
+                print ('%.3f %s: %s' % (score, code, objective))
+    else:
+        # objective longvecs, objectives without concept vectors are cleared
+        objids, longvecs = objective_longvecs(dbcon)
+        dbcon.execute('UPDATE objectives SET longvec = NULL, shortvec = NULL')
+        utils.db_writeVectors(dbcon, 'objectives', 'longvec', objids, longvecs)
+        print (str(len(objids)) + ' objective vectors.')
+
+        # fit reduction on objective longvecs, apply to objective and concept longvecs
+        reduction = Reduction.fit(blocks(longvecs, 50000), args.dims)
+        reduction.save(reduction_file)
+        shortvecs = reduction.transform(longvecs)
+        utils.db_writeVectors(dbcon, 'objectives', 'shortvec', objids, shortvecs)
+        conceptIds, conceptVecs = utils.db_readVectors(dbcon, 'concepts', 'longvec')
+        utils.db_writeVectors(dbcon, 'concepts', 'shortvec', conceptIds, reduction.transform(conceptVecs))
+
+        # similar objective pairs, for review of redundant objectives
+        pairs = similar_pairs(objids, shortvecs, args.top, args.threshold)
+        objectives = dict((row[0], row[1:]) for row in dbcon.execute('SELECT id, code, objective FROM objectives'))
+        with open('similarObjectives.csv', 'w', encoding = 'UTF8', newline = '') as f:
+            writer = csv.writer(f)
+            writer.writerow(['similarity', 'code1', 'objective1', 'code2', 'objective2'])
+            for a, b, score in pairs:
+                writer.writerow(['%.4f' % score] + list(objectives[a]) + list(objectives[b]))
+        print (str(len(pairs)) + ' similar objective pairs (cosine similarity >= ' + str(args.threshold) + ').')
+
+    dbcon.close()
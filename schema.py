@@ -0,0 +1,170 @@
+# Versioned database schema for the curriculum databases (curriculum.db, semantics.db): tables, indexes and connection settings.
+# The schema version is stored in the database (PRAGMA user_version). migrate() applies all migrations above the database's version
+# in order and records each new version. Migrations are idempotent (CREATE ... IF NOT EXISTS, missing columns only), so databases
+# created by older versions of the scripts (version 0) are upgraded in place, and an interrupted migration is simply repeated.
+# To change the schema, append a migration to MIGRATIONS, never edit one that has been released.
+#
+# usage: python schema.py [database file ...]   (upgrade databases to the current schema version, default curriculum.db and semantics.db)
+#
+# Stephan Bandelow, January 2024
+
+import sys
+import sqlite3
+import utils
+
+# connection settings: WAL journal (readers don't block the writer), fsync only at checkpoints, 64 MB page cache, 256 MB memory-mapped I/O
+PRAGMAS = [('journal_mode', 'WAL'), ('synchronous', 'NORMAL'), ('cache_size', -65536), ('mmap_size', 256 * 2**20)]
+
+# tables with data version counters, and the columns whose updates change the version
+VERSIONED_TABLES = [('objectives', 'course, module, discipline, lecture, title, code, objective'), ('objMap', 'objid, sentence, conceptid')]
+
+# base tables of the pipelines
+def create_tables (conn):
+    sql = 'CREATE TABLE IF NOT EXISTS objectives (id INTEGER PRIMARY KEY, course TEXT NOT NULL, module TEXT NOT NULL, discipline TEXT NOT NULL, lecture TEXT, title TEXT, code TEXT UNIQUE NOT NULL, objective TEXT NOT NULL, longvec ARRAY, shortvec ARRAY)' #longvec is sum of underlying concept vectors, shortvec is DR-compressed version
+    conn.execute(sql)
+    sql = 'CREATE TABLE IF NOT EXISTS objMap (id INTEGER PRIMARY KEY, objid INTEGER NOT NULL, sentence INTEGER DEFAULT 0, conceptid INTEGER NOT NULL, mmscore REAL, trigger TEXT)'
+    conn.execute(sql)
+    sql = 'CREATE TABLE IF NOT EXISTS concepts (id INTEGER PRIMARY KEY, cui TEXT, prefName TEXT, semtypes TEXT, meshcode TEXT, token TEXT NOT NULL, repeats INTEGER, longvec ARRAY, shortvec ARRAY)' #longvec from BioWordVec model (200 pos), shortvec are DR-compressed versions
+    conn.execute(sql)
+    sql = 'CREATE TABLE IF NOT EXISTS replaceMap (id INTEGER PRIMARY KEY, token TEXT UNIQUE NOT NULL, replace TEXT)'
+    conn.execute(sql)
+    sql = 'CREATE TABLE IF NOT EXISTS actionVerbs (id INTEGER PRIMARY KEY AUTOINCREMENT, verb TEXT NOT NULL, bloom INTEGER)'
+    conn.execute(sql)
+    sql = 'CREATE TABLE IF NOT EXISTS AVmap (objid INTEGER, sentence INTEGER, AVid INTEGER, verb TEXT, bloom REAL, PRIMARY KEY (objid, sentence))'
+    conn.execute(sql)
+
+# content hash of objective row, and hash of row content AVmap and objMap were last computed from (for incremental updates)
+def add_content_hashes (conn):
+    utils.db_addColumns(conn, 'objectives', [('hash', 'TEXT'), ('avhash', 'TEXT'), ('mmhash', 'TEXT')])
+    rows = conn.execute('SELECT id, course, module, discipline, lecture, title, code, objective FROM objectives WHERE hash IS NULL').fetchall()
+    conn.executemany('UPDATE objectives SET hash = ? WHERE id = ?', [(utils.objective_hash(row[1:]), row[0]) for row in rows])
+
+# dtype and dimension of compact vector columns, older .npy vector blobs are converted to the compact format
+def add_vector_columns (conn):
+    sql = 'CREATE TABLE IF NOT EXISTS vectorColumns (tablename TEXT NOT NULL, colname TEXT NOT NULL, dtype TEXT, dim INTEGER, PRIMARY KEY (tablename, colname))'
+    conn.execute(sql)
+    for table, column in utils.VECTOR_COLUMNS:
+        utils.db_migrateVectors(conn, table, column)
+
+# data version counters of objectives and objMap, changed by every write (key for caches of derived data, e.g. curriculum_overlap.py)
+def add_data_versions (conn):
+    sql = 'CREATE TABLE IF NOT EXISTS dataVersion (tablename TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0)'
+    conn.execute(sql)
+    for table, columns in VERSIONED_TABLES:
+        conn.execute('INSERT OR IGNORE INTO dataVersion (tablename) VALUES (?)', (table,))
+        for event in ('INSERT', 'DELETE', 'UPDATE OF ' + columns):
+            name = table + '_' + event.split()[0].lower() + '_version'
+            conn.execute('CREATE TRIGGER IF NOT EXISTS ' + name + ' AFTER ' + event + ' ON ' + table + " BEGIN UPDATE dataVersion SET version = version + 1 WHERE tablename = '" + table + "'; END")
+
+# materialized Bloom level summaries (bloom_summary.py): per objective sums with the group labels they were added under, and per group stats
+def add_bloom_summaries (conn):
+    sql = 'CREATE TABLE IF NOT EXISTS bloomObjStats (objid INTEGER PRIMARY KEY, avhash TEXT, course TEXT, module TEXT, discipline TEXT, n INTEGER, total REAL, sumsq REAL)'
+    conn.execute(sql)
+    sql = 'CREATE TABLE IF NOT EXISTS bloomStats (grouping TEXT NOT NULL, label TEXT NOT NULL, n INTEGER, total REAL, sumsq REAL, mean REAL, sd REAL, ci95 REAL, PRIMARY KEY (grouping, label))'
+    conn.execute(sql)
+
+# secondary indexes for the joins and lookups of the pipelines and analyses (AVmap lookups by objid use its primary key)
+#   objMap (objid, conceptid): objMap rows of objectives (incremental updates, db_deleteObjMap), covers the objectives x concepts incidence query
+#   objMap (conceptid): objectives of a concept, joins from concepts
+#   concepts (cui): concept lookup by CUI
+def add_indexes (conn):
+    conn.execute('CREATE INDEX IF NOT EXISTS objMap_objid_conceptid ON objMap (objid, conceptid)')
+    conn.execute('CREATE INDEX IF NOT EXISTS objMap_conceptid ON objMap (conceptid)')
+    conn.execute('CREATE INDEX IF NOT EXISTS concepts_cui ON concepts (cui)')
+
+# several action verbs per sentence (utils.ActionVerbMatcher): AVmap rows are keyed by objective, sentence and verb number (0 = primary
+# action verb), with the character position of the verb in the sentence. Existing rows become verb 0 with unknown position.
+def add_verb_numbers (conn):
+    if 'verbnum' in [row[1] for row in conn.execute('PRAGMA table_info(AVmap)')]:
+        return
+    conn.execute('DROP TABLE IF EXISTS AVmap_new')
+    sql = 'CREATE TABLE AVmap_new (objid INTEGER, sentence INTEGER, verbnum INTEGER DEFAULT 0, AVid INTEGER, verb TEXT, bloom REAL, position INTEGER, PRIMARY KEY (objid, sentence, verbnum))'
+    conn.execute(sql)
+    conn.execute('INSERT INTO AVmap_new (objid, sentence, verbnum, AVid, verb, bloom) SELECT objid, sentence, 0, AVid, verb, bloom FROM AVmap')
+    conn.execute('DROP TABLE AVmap')
+    conn.execute('ALTER TABLE AVmap_new RENAME TO AVmap')
+
+# Bloom level summaries count the primary action verb of each sentence only: summaries built from all action verbs are cleared,
+# and rebuilt by the next bloom_summary.update_summaries
+def reset_bloom_summaries (conn):
+    conn.execute('DELETE FROM bloomObjStats')
+    conn.execute('DELETE FROM bloomStats')
+
+# hash of objective text only: action verbs (avhash) and concepts (mmhash) are only recomputed when the text changes, not when
+# only metadata changes (hash covers all fields and decides upserts). Results computed from the current row are kept.
+def add_text_hashes (conn):
+    utils.db_addColumns(conn, 'objectives', [('texthash', 'TEXT')])
+    rows = conn.execute('SELECT id, objective FROM objectives WHERE texthash IS NULL').fetchall()
+    conn.executemany('UPDATE objectives SET texthash = ? WHERE id = ?', [(utils.text_hash(row[1]), row[0]) for row in rows])
+    conn.execute('UPDATE bloomObjStats SET avhash = (SELECT texthash FROM objectives WHERE id = objid) WHERE avhash = (SELECT hash FROM objectives WHERE id = objid)')
+    for column in ('avhash', 'mmhash'):
+        conn.execute('UPDATE objectives SET ' + column + ' = texthash WHERE ' + column + ' = hash')
+
+# indexes for the analysis joins by group, which read every objective: objectives are scanned in module order (GROUP BY module
+# without sorting), and the Bloom levels of each objective are read from an index instead of AVmap rows
+#   objectives (module, id): objectives grouped by module
+#   AVmap (objid, verbnum, bloom): Bloom levels by objective, primary action verb (verbnum = 0) or all
+def add_analysis_indexes (conn):
+    conn.execute('CREATE INDEX IF NOT EXISTS objectives_module ON objectives (module, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS AVmap_objid_bloom ON AVmap (objid, verbnum, bloom)')
+
+# (version, description, migration function), in order
+MIGRATIONS = [
+    (1, 'base tables', create_tables),
+    (2, 'objective content hashes', add_content_hashes),
+    (3, 'compact vector columns', add_vector_columns),
+    (4, 'data version counters', add_data_versions),
+    (5, 'Bloom level summary tables', add_bloom_summaries),
+    (6, 'secondary indexes', add_indexes),
+    (7, 'multiple action verbs per sentence', add_verb_numbers),
+    (8, 'Bloom level summaries of primary action verbs', reset_bloom_summaries),
+    (9, 'objective text hashes', add_text_hashes),
+    (10, 'analysis indexes', add_analysis_indexes),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def get_version (conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+# apply all migrations above the database's schema version, up to version (default: latest)
+# return: list of applied migration versions
+def migrate (conn, version = SCHEMA_VERSION):
+    current = get_version(conn)
+    if current > SCHEMA_VERSION:
+        raise RuntimeError('Database schema version ' + str(current) + ' is newer than this version of the scripts (' + str(SCHEMA_VERSION) + ')')
+    applied = []
+    for number, description, migration in MIGRATIONS:
+        if current < number <= version:
+            migration(conn)
+            conn.execute('PRAGMA user_version = ' + str(number))
+            conn.commit()
+            applied.append(number)
+    return applied
+
+# update the table and index statistics of the query planner, after migrations and bulk writes (tables that were rebuilt or
+# filled since the last update have no or outdated statistics). Statistics are sampled (analysis_limit), so this takes
+# milliseconds at any database size.
+def optimize (conn):
+    if conn.in_transaction:
+        conn.commit()
+    conn.execute('PRAGMA analysis_limit = 1000')
+    conn.execute('ANALYZE')
+    conn.commit()
+
+# set connection pragmas (per connection, except journal_mode which is stored in the database)
+def configure (conn):
+    if conn.in_transaction:
+        conn.commit()   # journal mode can't change inside a transaction
+    for name, value in PRAGMAS:
+        conn.execute('PRAGMA ' + name + ' = ' + str(value))
+
+
+if __name__ == '__main__':
+    for dbfile in sys.argv[1:] or ['curriculum.db', 'semantics.db']:
+        dbcon = sqlite3.connect(dbfile)
+        version = get_version(dbcon)
+        configure(dbcon)
+        applied = migrate(dbcon)
+        optimize(dbcon)
+        print (dbfile + ': schema version ' + str(version) + ' -> ' + str(get_version(dbcon)) + (', applied ' + ', '.join(str(number) + ' (' + description + ')' for number, description, migration in MIGRATIONS if number in applied) if applied else ''))
+        dbcon.close()
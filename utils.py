@@ -1,26 +1,52 @@
 # data handling utilities for BME processing, token list handling and DB format conversions
 # Stephan Bandelow, Janaury 2024
 
+import re
+import sys
+import json
+import time
 import sqlite3
+import hashlib
 import numpy as np
 import io   # for array <-> byte conversions
+from bisect import bisect_right
+from itertools import islice
+from contextlib import contextmanager, nullcontext
+from collections import OrderedDict, Counter, namedtuple
+from importlib import metadata
 from sentence_splitter import split_text_into_sentences
 #from nltk.tokenize import sent_tokenize #split into sentences. Doesn't deal well with abbreviations (e.g., i.e., etc), sentence splitter above works better.
 
-# database schema
+# database schema: create or upgrade all tables and indexes (schema.py), and set connection pragmas
+# query planner statistics are updated after migrations (schema.optimize, also called by the pipelines after bulk writes)
 def createTables (conn):
-    sql = 'CREATE TABLE IF NOT EXISTS objectives (id INTEGER PRIMARY KEY, course TEXT NOT NULL, module TEXT NOT NULL, discipline TEXT NOT NULL, lecture TEXT, title TEXT, code TEXT UNIQUE NOT NULL, objective TEXT NOT NULL, longvec ARRAY, shortvec ARRAY)' #longvec is sum of underlying concept vectors, shortvec is DR-compressed version
-    conn.execute(sql)
-    sql = 'CREATE TABLE IF NOT EXISTS objMap (id INTEGER PRIMARY KEY, objid INTEGER NOT NULL, sentence INTEGER DEFAULT 0, conceptid INTEGER NOT NULL, mmscore REAL, trigger TEXT)'
-    conn.execute(sql)
-    sql = 'CREATE TABLE IF NOT EXISTS concepts (id INTEGER PRIMARY KEY, cui TEXT, prefName TEXT, semtypes TEXT, meshcode TEXT, token TEXT NOT NULL, repeats INTEGER, longvec ARRAY, shortvec ARRAY)' #longvec from BioWordVec model (200 pos), shortvec are DR-compressed versions
-    conn.execute(sql)
-    sql = 'CREATE TABLE IF NOT EXISTS replaceMap (id INTEGER PRIMARY KEY, token TEXT UNIQUE NOT NULL, replace TEXT)'
-    conn.execute(sql)
-    sql = 'CREATE TABLE IF NOT EXISTS actionVerbs (id INTEGER PRIMARY KEY, token TEXT UNIQUE NOT NULL)'
-    conn.execute(sql)
-    sql = 'CREATE TABLE IF NOT EXISTS AVmap (objid INTEGER, sentence INTEGER, AVid INTEGER, verb TEXT, bloom REAL, PRIMARY KEY (objid, sentence))'
-    conn.commit()
+    import schema
+    schema.configure(conn)
+    if schema.migrate(conn):
+        schema.optimize(conn)
+
+# data versions of tables (tuple), e.g. to check whether a cache of derived data is still valid
+# (PRAGMA data_version only counts changes seen by one connection, these counters persist in the DB)
+def db_dataVersion (conn, tables):
+    versions = dict(conn.execute('SELECT tablename, version FROM dataVersion'))
+    return tuple(versions.get(table, 0) for table in tables)
+
+# add missing columns to existing table (created with an older version of the schema)
+def db_addColumns (conn, table, columns):
+    existing = [row[1] for row in conn.execute('PRAGMA table_info(' + table + ')')]
+    for name, decl in columns:
+        if name not in existing:
+            conn.execute('ALTER TABLE ' + table + ' ADD COLUMN ' + name + ' ' + decl)
+
+# content hash of objective fields (course, module, discipline, lecture, title, code, objective), to detect changed objectives
+def objective_hash (fields):
+    text = '\x1f'.join('' if field is None else str(field) for field in fields)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+# content hash of objective text only, action verbs and concepts are derived from the text, so they are only recomputed
+# when the text changes (not when e.g. a module is renamed)
+def text_hash (text):
+    return objective_hash([text])
 
 # wrapper for sentence tokenizer to allow easy swapping out of underlying function
 # arguments: multi-sentence text
@@ -30,11 +56,74 @@ def splitSentences (text):
     sents = split_text_into_sentences(text = text, language='en') #works well for most objectives
     return sents
 
+# version of sentence splitting, part of the sentence cache key (change when splitSentences is modified)
+try:
+    SPLITTER_VERSION = 'sentence-splitter ' + metadata.version('sentence-splitter') + ', en'
+except metadata.PackageNotFoundError:
+    SPLITTER_VERSION = 'sentence-splitter, en'
+
+# memoizing wrapper for splitSentences, so unchanged objectives are never split twice
+# results are kept in an in-process LRU and in a SQLite table (keyed by hash of splitter version and text),
+# which persists between pipeline runs and is shared by extract_actionverbs.py and map_concepts_metamap.py
+# counts: hits (in-process), dbhits (SQLite table), misses (text was split)
+class SentenceCache:
+    def __init__(self, dbfile = 'cache.db', maxsize = 10000, flushsize = 1000):
+        self.conn = sqlite3.connect(dbfile, timeout = 60)   # cache can be shared by several worker processes
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS sentences (hash TEXT PRIMARY KEY, sentences TEXT NOT NULL)')
+        self.conn.commit()
+        self.maxsize = maxsize
+        self.flushsize = flushsize
+        self.lru = OrderedDict()
+        self.pending = []   # new entries not yet written to DB
+        self.counts = {'hits': 0, 'dbhits': 0, 'misses': 0}
+
+    @staticmethod
+    def key (text):
+        return hashlib.sha1((SPLITTER_VERSION + '\0' + text).encode('utf-8')).hexdigest()
+
+    def split (self, text):
+        key = self.key(text)
+        if key in self.lru:
+            self.lru.move_to_end(key)
+            self.counts['hits'] += 1
+            return list(self.lru[key])
+        row = self.conn.execute('SELECT sentences FROM sentences WHERE hash = ?', (key,)).fetchone()
+        if row is not None:
+            sents = json.loads(row[0])
+            self.counts['dbhits'] += 1
+        else:
+            sents = splitSentences(text)
+            self.pending.append((key, json.dumps(sents)))
+            self.counts['misses'] += 1
+            if len(self.pending) >= self.flushsize:
+                self.commit()
+        self.lru[key] = tuple(sents)
+        if len(self.lru) > self.maxsize:
+            self.lru.popitem(last = False)
+        return sents
+
+    # write new entries to DB
+    def commit (self):
+        if self.pending:
+            self.conn.executemany('INSERT OR IGNORE INTO sentences VALUES (?, ?)', self.pending)
+            self.conn.commit()
+            self.pending = []
+
+    # return hit/miss counts since last reset and reset them
+    def reset_counts (self):
+        counts = self.counts
+        self.counts = dict.fromkeys(counts, 0)
+        return counts
+
+    def close (self):
+        self.commit()
+        self.conn.close()
+
 # helper dictionaries for pre-processing
 actverb_mods = {"using", "given", "based_on", "from"}  #action verb modifiers, where it appears after first comma
 
-# return action verb from sentence
-# TODO: include potential additional action verbs per sentence (e.g. 'describe and analyse...' or 'list, describe and analyse...')
+# return action verb from sentence (primary action verb only, ActionVerbMatcher finds all action verbs of a sentence)
 def get_actverb (sentence, dict_AV, dict_RPL):
     sentence = sentence.lower()
     sentence = replace_all(sentence, dict_RPL)
@@ -59,6 +148,145 @@ def get_actverb (sentence, dict_AV, dict_RPL):
                 return actverb
     return ''
 
+# action verb match: verb, database id and Bloom level (actionVerbs row), character position in sentence, token index
+ActionVerb = namedtuple('ActionVerb', ['verb', 'AVid', 'bloom', 'position', 'index'])
+
+# compiled action verb matcher, built once from the action verb table (rows id, verb, bloom) and the token replacement dictionary
+# Each sentence is tokenized once (lowercase words and separators) and matched against a lexicon trie of words, so multi-word
+# entries (e.g. 'break down' -> break_down, 'based on' -> based_on) and single word replacements (typos, e.g. 'desribe') are
+# recognised without replacing text. The primary action verb is the first word, or the first word after the first comma if the
+# sentence starts with an action verb modifier, else the first action verb in the sentence. These are the rules of get_actverb,
+# except that words are matched without attached punctuation: get_actverb skips words with a trailing comma, full stop or
+# bracket when it searches the sentence, so 'Based visualise, trace the path' -> visualise (get_actverb: trace) and
+# 'Then explain.' -> explain (get_actverb: none). The primary action verb is followed by all action verbs coordinated with it
+# (e.g. 'list, describe and analyse').
+class ActionVerbMatcher:
+    MOD = 'mod'     # lexicon value for action verb modifiers
+    separators = {',', '/', '&', 'and', 'or'}
+    tokenizer = re.compile(r"[\w'+-]*\w|[,/&]")
+
+    def __init__(self, table_AV, dict_RPL = None, mods = actverb_mods):
+        self.trie = {}
+        for AVid, verb, bloom in table_AV:
+            self._add(verb.split('_'), (verb, AVid, bloom))  # same verb twice: last row wins, as in dict_AV
+            if '_' in verb:
+                self._add([verb], (verb, AVid, bloom))
+        for mod in mods:
+            self._add(mod.split('_'), self.MOD)
+            if '_' in mod:
+                self._add([mod], self.MOD)
+        # replacements that turn words into a single lexicon word are aliases of that word
+        for token, replace in (dict_RPL or {}).items():
+            words = self.tokenizer.findall(token.lower())
+            target = self.tokenizer.findall(replace.lower())
+            if words and len(target) == 1 and words != target:
+                value = self._lookup(target[0].split('_'))
+                if value is not None:
+                    self._add(words, value)
+
+    def _add (self, words, value):
+        node = self.trie
+        for word in words:
+            node = node.setdefault(word, {})
+        node[None] = value
+
+    def _lookup (self, words):
+        node = self.trie
+        for word in words:
+            node = node.get(word)
+            if node is None:
+                return None
+        return node.get(None)
+
+    # token i of a sentence scanned once: (token, start) pairs are taken from the finditer scan as far as they are needed
+    # return: token i, None past the end of the sentence
+    @staticmethod
+    def _token (tokens, scan, i):
+        if i < len(tokens):
+            return tokens[i][0]
+        for match in scan:
+            tokens.append((match.group(), match.start()))
+            if i < len(tokens):
+                return tokens[i][0]
+        return None
+
+    # longest lexicon entry starting at token i: (i, value, number of tokens), None if no entry
+    def _match_at (self, tokens, scan, i):
+        node = self.trie.get(self._token(tokens, scan, i))
+        if node is None:
+            return None
+        value, length = node.get(None), 1
+        j = i + 1
+        while len(node) > 1 or None not in node:   # longer entries continue from here
+            word = self._token(tokens, scan, j)
+            node = node.get(word) if word is not None else None
+            if node is None:
+                break
+            if None in node:
+                value, length = node[None], j - i + 1
+            j += 1
+        return None if value is None else (i, value, length)
+
+    # lexicon matches in sentence order from token start, other words are skipped
+    def _matches (self, tokens, scan, start = 0):
+        i = start
+        while True:
+            word = self._token(tokens, scan, i)
+            if word is None:
+                return
+            match = self._match_at(tokens, scan, i) if word in self.trie else None
+            if match is None:
+                i += 1
+            else:
+                yield match
+                i += match[2]
+
+    # all action verbs of sentence (list of ActionVerb), primary action verb first
+    # the sentence is tokenized once, and only as far as needed (usually the first few words)
+    def match (self, sentence):
+        tokens = []
+        scan = self.tokenizer.finditer(sentence.lower())
+        primary = self._match_at(tokens, scan, 0)
+        if primary is None or primary[1] == self.MOD:
+            after = None
+            if primary is not None:
+                # action verb position modifier at start, action verb after 1st comma
+                i = 1
+                word = self._token(tokens, scan, i)
+                while word not in (',', None):
+                    i += 1
+                    word = self._token(tokens, scan, i)
+                if word == ',':
+                    after = self._match_at(tokens, scan, i + 1)
+                    if after is not None and after[1] == self.MOD:
+                        after = None
+            if after is not None:
+                primary = after
+            else:
+                # no action verb in position 1, first action verb in sentence
+                primary = next((m for m in self._matches(tokens, scan) if m[1] != self.MOD), None)
+                if primary is None:
+                    return []
+        # action verbs coordinated with the primary action verb: separated only by separators (',', 'and', 'or', '/', '&')
+        verbs = [primary]
+        last = primary[0] + primary[2]
+        while True:
+            i = last
+            while self._token(tokens, scan, i) in self.separators:
+                i += 1
+            if i == last:
+                break
+            match = self._match_at(tokens, scan, i)
+            if match is None or match[1] == self.MOD:
+                break
+            verbs.append(match)
+            last = i + match[2]
+        return [ActionVerb(value[0], value[1], value[2], tokens[i][1], i) for i, value, length in verbs]
+
+    # action verbs of all sentences (list of lists)
+    def match_all (self, sentences):
+        return [self.match(sentence) for sentence in sentences]
+
 # returns results from query 'sql' as 2D data matrix (list of tuples, row = tuple)
 def db_readSQL(conn, sql):
     res = conn.execute (sql)
@@ -73,6 +301,160 @@ def db_writeSQL(conn, sql, data):
     conn.executemany(sql, data)
     conn.commit()
 
+# save rows from iterable (e.g. generator) to DB table in chunks of executemany calls, without loading all rows into memory
+# the writes are recorded as stage of profiler (StageProfiler, None = no profiling), producing the rows is not
+# return: number of rows written
+def db_writeChunks(conn, sql, rows, chunksize = 5000, profiler = None, stage = 'db write'):
+    count = 0
+    rows = iter(rows)
+    chunk = list(islice(rows, chunksize))
+    while chunk:
+        with profile_stage(profiler, stage, len(chunk)):
+            conn.executemany(sql, chunk)
+        count += len(chunk)
+        chunk = list(islice(rows, chunksize))
+    with profile_stage(profiler, stage):
+        conn.commit()
+    return count
+
+# delete objMap rows of objectives (list of objective IDs), and remove them from concept repeat counts
+def db_deleteObjMap(conn, objids):
+    repeats = Counter()
+    for objid in objids:
+        for conceptid, count in conn.execute('SELECT conceptid, COUNT(*) FROM objMap WHERE objid = ? GROUP BY conceptid', (objid,)):
+            repeats[conceptid] += count
+    conn.executemany('UPDATE concepts SET repeats = COALESCE(repeats, 0) - ? WHERE id = ?', [(count, conceptid) for conceptid, count in repeats.items()])
+    conn.executemany('DELETE FROM objMap WHERE objid = ?', [(objid,) for objid in objids])
+
+# registry of unique concepts (CUI -> concept ID), seeded from table concepts
+# new concepts and repeat counts (number of objMap rows per concept) are buffered and written by flush(), in the caller's transaction
+class ConceptRegistry:
+    def __init__(self, conn):
+        self.conn = conn
+        self.ids = dict(conn.execute('SELECT cui, id FROM concepts'))
+        self.nextid = (conn.execute('SELECT MAX(id) FROM concepts').fetchone()[0] or 0) + 1
+        self.new = []   # concept rows (id, cui, prefName, semtypes, meshcode, token) not yet in DB
+        self.repeats = Counter()
+
+    def __len__(self):
+        return len(self.ids)
+
+    # concept ID for MMI concept, new concepts are added to registry, counts one repeat
+    def add(self, concept):
+        concid = self.ids.get(concept.cui)
+        if concid is None:
+            concid = self.ids[concept.cui] = self.nextid
+            self.nextid += 1
+            self.new.append((concid, concept.cui, concept.preferred_name, concept.semtypes, concept.tree_codes, concept.preferred_name))
+        self.repeats[concid] += 1
+        return concid
+
+    def flush(self):
+        self.conn.executemany('INSERT INTO concepts (id, cui, prefName, semtypes, meshcode, token, repeats) VALUES (?, ?, ?, ?, ?, ?, 0)', self.new)
+        self.conn.executemany('UPDATE concepts SET repeats = COALESCE(repeats, 0) + ? WHERE id = ?', [(count, concid) for concid, count in self.repeats.items()])
+        self.new = []
+        self.repeats = Counter()
+
+# split iterable into lists of n items
+def chunks (items, n):
+    items = iter(items)
+    chunk = list(islice(items, n))
+    while chunk:
+        yield chunk
+        chunk = list(islice(items, n))
+
+# peak resident memory (MB) of this process since the last reset_peak_rss(), since process start where resetting isn't supported
+def peak_rss ():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None     # Windows
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 1024
+
+# reset peak resident memory (Linux only), return False if not supported
+def reset_peak_rss ():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+# lightweight instrumentation of pipeline runs: wall time, CPU time, items processed, throughput and peak memory per stage
+# A stage can be entered many times (e.g. once per chunk): times and items are summed, peak memory is the maximum over all
+# entries (peak since process start on platforms without reset_peak_rss). Stages are not nested.
+#   profiler = utils.StageProfiler(objectives = 10000)   # run info, written with the results
+#   with profiler.stage('split sentences', len(chunk)) as stage:
+#       stage['sentences'] += ...                         # extra counters
+#   profiler.save('pipeline_benchmark.jsonl')
+# The pipeline functions take an optional profiler and enter their stages with profile_stage, so they run unchanged without one.
+class StageProfiler:
+    def __init__(self, **info):
+        self.info = info
+        self.stages = {}
+        self.start = time.perf_counter()
+        self.perstage = reset_peak_rss()
+
+    @contextmanager
+    def stage(self, name, items = 0):
+        record = self.stages.setdefault(name, Counter(calls = 0, items = 0, wall_s = 0.0, cpu_s = 0.0, peak_rss_mb = None))
+        record['items'] += items
+        reset_peak_rss()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            record['calls'] += 1
+            record['wall_s'] += time.perf_counter() - wall
+            record['cpu_s'] += time.process_time() - cpu
+            peak = peak_rss()
+            if peak is not None:
+                record['peak_rss_mb'] = max(record['peak_rss_mb'] or 0, peak)
+
+    # run record: run info, total wall time and stage stats, with throughput (items per second of wall time)
+    def result (self):
+        stages = []
+        for name, record in self.stages.items():
+            stage = dict(stage = name, **record)
+            stage['items_per_s'] = record['items'] / record['wall_s'] if record['wall_s'] > 0 else None
+            stages.append(stage)
+        peaks = [stage['peak_rss_mb'] for stage in stages if stage['peak_rss_mb'] is not None]
+        return dict(self.info, wall_s = time.perf_counter() - self.start, peak_rss_mb = max(peaks) if peaks else None,
+                    peak_rss_per_stage = self.perstage, stages = stages)
+
+    # append run record to JSON lines file (one run per line)
+    def save (self, filename):
+        with open(filename, 'a', encoding = 'utf-8') as f:
+            f.write(json.dumps(self.result()) + '\n')
+
+# stage name of profiler (context yielding the stage record), a do-nothing stage if profiler is None
+def profile_stage (profiler, name, items = 0):
+    if profiler is None:
+        return nullcontext(Counter())
+    return profiler.stage(name, items)
+
+# items of iterable (e.g. a generator pipeline), produced in chunks of n items under stage name of profiler
+def profiled (items, profiler, name, n = 5000):
+    if profiler is None:
+        yield from items
+        return
+    items = iter(items)
+    while True:
+        with profile_stage(profiler, name) as stage:
+            chunk = list(islice(items, n))
+            stage['items'] += len(chunk)
+        if not chunk:
+            return
+        yield from chunk
+
 # read file with 1 token/row, return tokens as array
 def read_tokenlist(filename):
     tokens = []
@@ -142,13 +524,281 @@ def adapt_array(arr):
     return sqlite3.Binary(out.read())
 
 # byte sequence to array to load as np.array
+# reads both formats: .npy blobs (adapt_array) and compact raw float32 vectors (adapt_vector)
 def convert_array(text):
+    if text[:len(NPY_MAGIC)] != NPY_MAGIC:
+        return np.frombuffer(text, dtype = VECTOR_DTYPE).copy()
     out = io.BytesIO(text)
     out.seek(0)
     return np.load(out)
 
+
+############## compact vector storage ##################
+# vectors (1-D arrays, e.g. 200-dim BioWordVec longvec) are stored as raw float32 blobs without the per-row .npy header,
+# dtype and dimension are kept once per column in table vectorColumns. Whole columns are read into one contiguous matrix.
+
+NPY_MAGIC = b'\x93NUMPY'            # start of .npy format blobs (adapt_array)
+VECTOR_DTYPE = np.dtype('<f4')      # compact vector format: little endian float32
+VECTOR_COLUMNS = [('objectives', 'longvec'), ('objectives', 'shortvec'), ('concepts', 'longvec'), ('concepts', 'shortvec')]
+
+# vector to compact byte sequence for DB storage, other arrays (2-D etc.) keep the .npy format
+def adapt_vector(arr):
+    if arr.ndim != 1:
+        return adapt_array(arr)
+    return sqlite3.Binary(np.ascontiguousarray(arr, dtype = VECTOR_DTYPE).tobytes())
+
+# register numpy array adapter and ARRAY column converter, call before connecting with detect_types=sqlite3.PARSE_DECLTYPES
+# compact = False: store arrays in the old .npy format
+def register_arrays(compact = True):
+    sqlite3.register_adapter(np.ndarray, adapt_vector if compact else adapt_array)
+    sqlite3.register_converter('ARRAY', convert_array)
+
+# record dtype and dimension of vector column
+def db_setVectorDim(conn, table, column, dim):
+    sql = 'INSERT INTO vectorColumns (tablename, colname, dtype, dim) VALUES (?, ?, ?, ?) ON CONFLICT (tablename, colname) DO UPDATE SET dtype = excluded.dtype, dim = excluded.dim'
+    conn.execute(sql, (table, column, VECTOR_DTYPE.str, dim))
+
+# dimension of vector column (None if column has no vectors yet)
+def db_vectorDim(conn, table, column):
+    row = conn.execute('SELECT dim FROM vectorColumns WHERE tablename = ? AND colname = ?', (table, column)).fetchone()
+    if row is not None:
+        return row[0]
+    row = conn.execute('SELECT CAST(' + column + ' AS BLOB) FROM ' + table + ' WHERE ' + column + ' IS NOT NULL LIMIT 1').fetchone()
+    if row is None:
+        return None
+    return len(_compact_blob(row[0])) // VECTOR_DTYPE.itemsize
+
+# convert .npy vector blobs in column to compact format, return number of converted rows
+def db_migrateVectors(conn, table, column, chunksize = 5000):
+    ids = [row[0] for row in conn.execute('SELECT id FROM ' + table + ' WHERE substr(' + column + ', 1, ?) = ?', (len(NPY_MAGIC), sqlite3.Binary(NPY_MAGIC)))]
+    dim = None
+    for chunk in chunks(ids, chunksize):
+        sql = 'SELECT id, CAST(' + column + ' AS BLOB) FROM ' + table + ' WHERE id IN (' + ', '.join('?' * len(chunk)) + ')'
+        rows = []
+        for objid, blob in conn.execute(sql, chunk):
+            arr = convert_array(blob)
+            if arr.ndim == 1:   # other arrays stay in .npy format
+                rows.append((adapt_vector(arr), objid))
+                dim = len(arr)
+        conn.executemany('UPDATE ' + table + ' SET ' + column + ' = ? WHERE id = ?', rows)
+    if dim is not None:
+        db_setVectorDim(conn, table, column, dim)
+    conn.commit()
+    return len(ids)
+
+# write vectors (matrix rows) of rows ids to column
+def db_writeVectors(conn, table, column, ids, matrix):
+    matrix = np.ascontiguousarray(matrix, dtype = VECTOR_DTYPE)
+    db_setVectorDim(conn, table, column, matrix.shape[1])
+    sql = 'UPDATE ' + table + ' SET ' + column + ' = ? WHERE id = ?'
+    return db_writeChunks(conn, sql, ((sqlite3.Binary(vec.tobytes()), int(rowid)) for rowid, vec in zip(ids, matrix)))
+
+# read all vectors of column, return row ids (int64 array) and float32 matrix (one row per id, in id order)
+# out: optional preallocated output (e.g. memory-mapped .npy file), with at least as many rows as vectors in column
+def db_readVectors(conn, table, column, out = None, chunksize = 5000):
+    count = conn.execute('SELECT COUNT(' + column + ') FROM ' + table).fetchone()[0]
+    dim = db_vectorDim(conn, table, column) or 0
+    if out is None:
+        out = np.empty((count, dim), dtype = VECTOR_DTYPE)
+    ids = np.empty(count, dtype = np.int64)
+    rowbytes = dim * VECTOR_DTYPE.itemsize
+    buf = memoryview(out.reshape(-1)).cast('B')     # raw blobs are copied straight into the matrix
+    cursor = conn.execute('SELECT id, CAST(' + column + ' AS BLOB) FROM ' + table + ' WHERE ' + column + ' IS NOT NULL ORDER BY id')
+    idx = 0
+    rows = cursor.fetchmany(chunksize)
+    while rows:
+        for rowid, blob in rows:
+            blob = _compact_blob(blob)
+            if len(blob) != rowbytes:
+                raise ValueError('db_readVectors: vector of row ' + str(rowid) + ' in ' + table + '.' + column + ' has ' + str(len(blob) // VECTOR_DTYPE.itemsize) + ' values, expected ' + str(dim))
+            ids[idx] = rowid
+            buf[idx * rowbytes:(idx + 1) * rowbytes] = blob
+            idx += 1
+        rows = cursor.fetchmany(chunksize)
+    return ids, out[:count]
+
+# compact raw bytes of vector blob in either format
+def _compact_blob(blob):
+    if blob[:len(NPY_MAGIC)] == NPY_MAGIC:
+        return np.ascontiguousarray(convert_array(blob), dtype = VECTOR_DTYPE).tobytes()
+    return blob
+
+# sidecar vector store: memory-mapped copy of a vector column, for analyses that need random access to many vectors
+# files: filename.npy (float32 matrix, one row per vector) and filename.ids.npy (sorted row ids)
+# the store is a snapshot, rebuild it with VectorStore.build() after the column was updated
+class VectorStore:
+    def __init__(self, filename):
+        self.ids = np.load(filename + '.ids.npy')
+        self.matrix = np.load(filename + '.npy', mmap_mode = 'r')
+
+    # write vector column table.column to sidecar files, return opened store
+    @classmethod
+    def build(cls, conn, table, column, filename):
+        count = conn.execute('SELECT COUNT(' + column + ') FROM ' + table).fetchone()[0]
+        dim = db_vectorDim(conn, table, column) or 0
+        out = np.lib.format.open_memmap(filename + '.npy', mode = 'w+', dtype = VECTOR_DTYPE, shape = (count, dim))
+        ids, matrix = db_readVectors(conn, table, column, out)
+        out.flush()
+        del out, matrix
+        np.save(filename + '.ids.npy', ids)
+        return cls(filename)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, rowid):
+        idx = np.searchsorted(self.ids, rowid)
+        return idx < len(self.ids) and self.ids[idx] == rowid
+
+    # vectors of row ids (matrix, in order of ids)
+    def get(self, ids):
+        ids = np.asarray(ids, dtype = np.int64)
+        idx = np.searchsorted(self.ids, ids)
+        idx[idx >= len(self.ids)] = 0
+        missing = self.ids[idx] != ids if len(self.ids) else np.ones(len(ids), dtype = bool)
+        if missing.any():
+            raise KeyError('VectorStore: no vector for row ids ' + str(ids[missing][:10].tolist()))
+        return np.asarray(self.matrix[idx])
+
+    def __getitem__(self, rowid):
+        return self.get([rowid])[0]
+
 # replace all dictionary dict terms in text
+# dict can also be a compiled Replacer (same output, much faster for large dictionaries)
 def replace_all(text, dict):
+    if isinstance(dict, Replacer):
+        return dict.replace(text)
     for i, j in dict.items():
         text = text.replace(i, j)
     return text
+
+# compiled replacement dictionary, build once (e.g. from dict_RPL or dict_PREP) and reuse for all texts
+# output is identical to the ordered replace_all() loop, but only dictionary terms found in the text are replaced:
+# a single regex pass over the text finds all terms present, which are then replaced in dictionary order.
+# Replacements that can create new dictionary terms (e.g. removing brackets) trigger a re-scan of the text.
+# Small dictionaries are faster with the plain replace loop, which is used below minTokens entries.
+class Replacer:
+    minTokens = 400
+
+    def __init__(self, dictionary):
+        self.tokens = list(dictionary.keys())
+        self.replacements = list(dictionary.values())
+        if '' in dictionary:
+            raise ValueError('Replacer: empty token in replacement dictionary')
+        self.index = {token: idx for idx, token in enumerate(self.tokens)}
+        # several tokens can start at the same text position if they are prefixes of each other
+        self.prefixes = [[self.index[token[:n]] for n in range(1, len(token) + 1) if token[:n] in self.index] for token in self.tokens]
+        self.creates = self._creating()
+        self.pattern = re.compile('(?=(' + _trie_pattern(self.tokens) + '))') if self.tokens else None
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __call__(self, text):
+        return self.replace(text)
+
+    # return indices of all dictionary tokens found in text, in dictionary order
+    def scan(self, text):
+        found = set()
+        if self.pattern is not None:
+            for match in self.pattern.finditer(text):
+                found.update(self.prefixes[self.index[match.group(1)]])
+        return sorted(found)
+
+    def replace(self, text):
+        if len(self.tokens) < self.minTokens:
+            for token, repl in zip(self.tokens, self.replacements):
+                text = text.replace(token, repl)
+            return text
+        found = self.scan(text)
+        pos = 0
+        while pos < len(found):
+            idx = found[pos]
+            pos += 1
+            token = self.tokens[idx]
+            if token in text:   # may have been removed by an earlier replacement
+                text = text.replace(token, self.replacements[idx])
+                created = self.creates[idx]
+                if created is None:
+                    # replacement may have created many different later tokens, re-scan
+                    found = [i for i in self.scan(text) if i > idx]
+                    pos = 0
+                elif created:
+                    # add the few later tokens this replacement could have created
+                    found = sorted(set(found[pos:]).union(created))
+                    pos = 0
+        return text
+
+    # list later dictionary tokens that each replacement can create, i.e. that weren't in the text before
+    # (token overlapping the inserted replacement text in a way not already matched by the replaced token)
+    # None if there are too many, then the text is re-scanned after the replacement
+    def _creating(self, limit = 32):
+        suffixes = {}   # dictionary indices of tokens with this proper suffix
+        prefixes = {}   # dictionary indices of tokens with this proper prefix
+        for idx, token in enumerate(self.tokens):
+            for n in range(1, len(token)):
+                suffixes.setdefault(token[-n:], []).append(idx)
+                prefixes.setdefault(token[:n], []).append(idx)
+        # token inner parts (without first and last char), to find replacements fully enclosed by a later token
+        inner = '\0'.join(token[1:-1] for token in self.tokens)
+        offsets = [0]
+        for token in self.tokens:
+            offsets.append(offsets[-1] + max(len(token) - 2, 0) + 1)
+        enclosing = {}
+        longTokens = [idx for idx, token in enumerate(self.tokens) if len(token) > 1]
+        creates = []
+        for idx, (token, repl) in enumerate(zip(self.tokens, self.replacements)):
+            if token == repl:
+                creates.append([])
+                continue
+            if repl == '':
+                # removal joins the text around the token, can create any later token with > 1 char
+                created = longTokens[bisect_right(longTokens, idx):]
+                creates.append(created if len(created) <= limit else None)
+                continue
+            if '\0' in repl:
+                creates.append(None)    # can't check, always re-scan
+                continue
+            created = set()
+            # later token inside replacement text
+            for a in range(len(repl)):
+                for b in range(a + 1, len(repl) + 1):
+                    created.add(self.index.get(repl[a:b], -1))
+            # later token ending with start of replacement text, or starting with end of replacement text
+            for n in range(1, len(repl) + 1):
+                if n > len(token) or token[:n] != repl[:n]:
+                    created.update(suffixes.get(repl[:n], ()))
+                if n > len(token) or token[-n:] != repl[-n:]:
+                    created.update(prefixes.get(repl[-n:], ()))
+            # later token enclosing the full replacement text
+            if repl not in enclosing:
+                enclosing[repl] = []
+                pos = inner.find(repl)
+                while pos >= 0:
+                    enclosing[repl].append(bisect_right(offsets, pos) - 1)
+                    pos = inner.find(repl, pos + 1)
+            created.update(enclosing[repl])
+            created = sorted(i for i in created if i > idx)
+            creates.append(created if len(created) <= limit else None)
+        return creates
+
+# regex alternation of all tokens, factored as a trie so matching cost doesn't grow with dictionary size
+# longest token wins at each position
+def _trie_pattern(tokens):
+    trie = {}
+    for token in tokens:
+        node = trie
+        for char in token:
+            node = node.setdefault(char, {})
+        node[''] = True     # end of token marker
+    return _trie_node(trie)
+
+def _trie_node(node):
+    alts = [re.escape(char) + _trie_node(child) for char, child in node.items() if char != '']
+    if not alts:
+        return ''
+    pattern = alts[0] if len(alts) == 1 else '(?:' + '|'.join(alts) + ')'
+    if '' in node:
+        # token ends here but may continue, optional (greedy) continuation
+        pattern = '(?:' + pattern + ')?'
+    return pattern